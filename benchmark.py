@@ -0,0 +1,198 @@
+"""
+Synthetic stereo benchmark.
+
+Renders rectified stereo pairs with the camera constants in functions.py
+(a textured ground plane with a known normal, a far wall and box
+obstacles), runs performStereoVision over them and reports the p50/p95
+latency of every stage and of the whole pipeline, together with the
+angle between the fitted and the true road normal.
+
+    python3 benchmark.py                    # compare with the stored baseline
+    python3 benchmark.py --update-baseline  # store the current results
+
+The run fails (exit code 1) if a latency or the normal error regresses
+past the stored baseline, or if there is no stored baseline.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import numpy as np
+import cv2
+import functions as f
+import stereovision as sv
+import profiling as prof
+
+# -------------------------------------------------------------------
+# SCENE RENDERING
+# -------------------------------------------------------------------
+
+def makeTexture(rng, size=1024):
+    # multi scale noise s.t the matcher has texture at every distance.
+    texture = np.zeros((size, size), np.float32)
+    for cells, weight in ((16, 0.5), (64, 0.3), (size, 0.2)):
+        noise = rng.random((cells, cells)).astype(np.float32)
+        texture += weight * cv2.resize(noise, (size, size), interpolation=cv2.INTER_LINEAR)
+    return np.clip(texture * 255, 0, 255).astype(np.uint8)
+
+def makeScene(rng, frame):
+    # a slightly pitched and rolled ground plane, seen from a camera
+    # moving forwards, with a few boxes standing on it.
+    pitch = math.radians(rng.uniform(-3, 3))
+    roll = math.radians(rng.uniform(-2, 2))
+    normal = np.array([math.sin(roll), math.cos(roll) * math.cos(pitch), math.cos(roll) * math.sin(pitch)])
+    boxes = []
+    for _ in range(rng.integers(1, 4)):
+        z = rng.uniform(6, 25)
+        x = rng.uniform(-4, 3)
+        boxes.append((x, x + rng.uniform(0.5, 2.0), z, rng.uniform(0.5, 1.8)))
+    return {'normal': normal, 'height': rng.uniform(1.4, 1.7), 'boxes': boxes, 'offset': frame * 0.5}
+
+def renderView(scene, textures, camera_x, size):
+    height, width = size
+    f_px = f.camera_focal_length_px
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    # ray direction of every pixel, scaled s.t its z component is 1.
+    dx = (xs - f.image_centre_w) / f_px
+    dy = (ys - f.image_centre_h) / f_px
+    n = scene['normal']
+    # depth and texture coordinates of the nearest surface per pixel.
+    depth = np.full(size, np.inf, np.float32)
+    u = np.zeros(size, np.float32)
+    v = np.zeros(size, np.float32)
+    surface = np.zeros(size, np.uint8)
+
+    def nearest(z, valid, su, sv_, index):
+        hit = valid & (z > 0) & (z < depth)
+        depth[hit] = z[hit]
+        u[hit] = su[hit]
+        v[hit] = sv_[hit]
+        surface[hit] = index
+
+    # a far wall behind everything.
+    wall = np.full(size, 60.0, np.float32)
+    nearest(wall, np.ones(size, bool), (camera_x + dx * wall) * 20, (dy * wall) * 20, 0)
+    # the ground plane n.P = h.
+    facing = n[0] * dx + n[1] * dy + n[2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ground = ((scene['height'] - n[0] * camera_x) / facing).astype(np.float32)
+    X = camera_x + dx * ground
+    nearest(ground, facing > 1e-6, X * 100, (ground + scene['offset']) * 100, 1)
+    # the front face of every box.
+    for x0, x1, z, box_height in scene['boxes']:
+        X = camera_x + dx * z
+        Y = dy * z
+        front = (X >= x0) & (X <= x1) & (Y <= scene['height']) & (Y >= scene['height'] - box_height)
+        nearest(np.full(size, z, np.float32), front, X * 150, Y * 150, 2)
+
+    image = np.zeros((height, width, 3), np.uint8)
+    for index, (texture, tint) in enumerate(textures):
+        mask = surface == index
+        sampled = cv2.remap(texture, u, v, cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP)
+        for channel in range(3):
+            image[..., channel][mask] = np.clip(sampled[mask] * tint[channel], 0, 255)
+    return image
+
+def renderStereoPair(scene, textures, size):
+    # the right camera sits one baseline to the right of the left camera.
+    return (renderView(scene, textures, 0.0, size),
+            renderView(scene, textures, f.stereo_camera_baseline_m, size))
+
+def normalAngleError(normal, true_normal):
+    # angle in degrees between the fitted and the true plane normal.
+    if normal is None:
+        return 90.0
+    normal = np.ravel(normal)
+    cosine = abs(np.dot(normal, true_normal)) / (np.linalg.norm(normal) * np.linalg.norm(true_normal))
+    return math.degrees(math.acos(min(1.0, cosine)))
+
+# -------------------------------------------------------------------
+# BENCHMARK
+# -------------------------------------------------------------------
+
+def runBenchmark(frames=30, seed=0, options=None):
+    rng = np.random.default_rng(seed)
+    opt = dict(sv.default_opts)
+    opt.update({'loop': False, 'record_stats': False, 'headless': False})
+    if options:
+        opt.update(options)
+    size = opt['img_size']
+    textures = [(makeTexture(rng), (1.0, 0.9, 0.8)),
+                (makeTexture(rng), (0.9, 0.9, 0.9)),
+                (makeTexture(rng), (0.4, 0.5, 1.0))]
+    timings = {stage: [] for stage in prof.stages + ["Taken"]}
+    errors = []
+    previousDisparity = None
+    workspace = f.Workspace()
+    for frame in range(frames):
+        scene = makeScene(rng, frame)
+        imgL, imgR = renderStereoPair(scene, textures, size)
+        stats = {}
+        _, previousDisparity, normal = sv.performStereoVision(imgL, imgR, previousDisparity, opt, stats, workspace=workspace, frame=frame + 1)
+        for stage in timings:
+            timings[stage].append(stats["Time " + stage])
+        errors.append(normalAngleError(normal, scene['normal']))
+
+    results = {'frames': frames}
+    for stage, values in timings.items():
+        results["Time " + stage] = {'p50': float(np.percentile(values, 50)),
+                                    'p95': float(np.percentile(values, 95))}
+    results['Normal Error'] = {'p50': float(np.percentile(errors, 50)),
+                               'p95': float(np.percentile(errors, 95))}
+    return results
+
+def compareToBaseline(results, baseline, time_tolerance=0.25, time_slack=0.002, angle_slack=0.5):
+    # returns a list of the metrics that regressed past the baseline.
+    failures = []
+    for metric, values in results.items():
+        if metric not in baseline or not isinstance(values, dict):
+            continue
+        for percentile in ('p50', 'p95'):
+            current = values[percentile]
+            allowed = baseline[metric][percentile]
+            if metric == 'Normal Error':
+                allowed += angle_slack
+            else:
+                allowed = allowed * (1 + time_tolerance) + time_slack
+            if current > allowed:
+                failures.append("%s %s: %.4f > %.4f" % (metric, percentile, current, allowed))
+    return failures
+
+def printResults(results):
+    print("%-22s %10s %10s" % ("metric", "p50", "p95"))
+    for metric, values in results.items():
+        if isinstance(values, dict):
+            print("%-22s %10.4f %10.4f" % (metric, values['p50'], values['p95']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="synthetic stereo benchmark")
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default="benchmark_baseline.json")
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = runBenchmark(args.frames, args.seed)
+    printResults(results)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print("Baseline saved to:", args.baseline)
+        return 0
+    if not os.path.isfile(args.baseline):
+        # a gate with nothing to compare against would always pass.
+        print("No baseline at", args.baseline, "(create one with --update-baseline)")
+        return 1
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    failures = compareToBaseline(results, baseline)
+    for failure in failures:
+        print("REGRESSION", failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
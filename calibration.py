@@ -0,0 +1,143 @@
+import hashlib
+import os
+import threading
+import cv2
+import numpy as np
+import functions as f
+
+# the nodes read from a calibration file. K1, D1 and K2, D2 are the camera
+# matrices and distortion coefficients of the left and right cameras, R and
+# T (metres) take points from the left camera to the right one.
+calibration_nodes = ('K1', 'D1', 'K2', 'D2', 'R', 'T')
+
+class Calibration(object):
+    """
+    The calibration of a raw (unrectified) stereo rig, and the rectification
+    it gives: the rotation and projection of each camera, and the camera
+    (focal length, baseline and centre) of the rectified images.
+    """
+
+    def __init__(self, size, K1, D1, K2, D2, R, T):
+        # size is (height, width) of the raw images.
+        self.size = tuple(int(x) for x in size[:2])
+        self.K1, self.D1, self.K2, self.D2 = [np.asarray(x, np.float64) for x in (K1, D1, K2, D2)]
+        self.R = np.asarray(R, np.float64).reshape((3, 3))
+        self.T = np.asarray(T, np.float64).reshape((3, 1))
+        height, width = self.size
+        # alpha=0 s.t the rectified images only hold valid pixels.
+        self.R1, self.R2, self.P1, self.P2, self.Q, _, _ = cv2.stereoRectify(
+            self.K1, self.D1, self.K2, self.D2, (width, height), self.R, self.T,
+            flags=cv2.CALIB_ZERO_DISPARITY, alpha=0)
+        # P2 = [f 0 cx -f*B], so the baseline is in the units of T.
+        focal_length = float(self.P1[0, 0])
+        self.camera = f.StereoCamera(focal_length, float(-self.P2[0, 3] / self.P2[0, 0]),
+                                     float(self.P1[0, 2]), float(self.P1[1, 2]))
+
+    def key(self):
+        # identifies the rectification maps of this calibration.
+        digest = hashlib.sha1(repr(self.size).encode())
+        for matrix in (self.K1, self.D1, self.K2, self.D2, self.R, self.T):
+            digest.update(np.ascontiguousarray(matrix).tobytes())
+        return digest.hexdigest()[:16]
+
+def loadCalibration(filename):
+    # a Calibration from an OpenCV FileStorage file (YAML, XML or JSON) with
+    # image_width, image_height and the calibration_nodes.
+    storage = cv2.FileStorage(filename, cv2.FILE_STORAGE_READ)
+    if not storage.isOpened():
+        raise IOError("cannot open calibration: " + str(filename))
+    try:
+        size = (int(storage.getNode('image_height').real()), int(storage.getNode('image_width').real()))
+        matrices = []
+        for name in calibration_nodes:
+            matrix = storage.getNode(name).mat()
+            if matrix is None:
+                raise ValueError("calibration " + str(filename) + " has no " + name)
+            matrices.append(matrix)
+    finally:
+        storage.release()
+    return Calibration(size, *matrices)
+
+def saveCalibration(filename, calibration):
+    # writes a calibration in the format loadCalibration reads.
+    storage = cv2.FileStorage(filename, cv2.FILE_STORAGE_WRITE)
+    storage.write('image_width', calibration.size[1])
+    storage.write('image_height', calibration.size[0])
+    for name in calibration_nodes:
+        storage.write(name, getattr(calibration, name))
+    storage.release()
+
+# -------------------------------------------------------------------
+# RECTIFICATION MAPS
+# -------------------------------------------------------------------
+
+def computeRectificationMaps(calibration):
+    # the fixed point remap tables of both cameras: (2, h, w, 2) int16 pixel
+    # positions and (2, h, w) uint16 interpolation table indices.
+    height, width = calibration.size
+    positions = np.empty((2, height, width, 2), np.int16)
+    fractions = np.empty((2, height, width), np.uint16)
+    cameras = ((calibration.K1, calibration.D1, calibration.R1, calibration.P1),
+               (calibration.K2, calibration.D2, calibration.R2, calibration.P2))
+    for i, (K, D, R, P) in enumerate(cameras):
+        positions[i], fractions[i] = cv2.initUndistortRectifyMap(K, D, R, P, (width, height), cv2.CV_16SC2)
+    return positions, fractions
+
+def rectificationCachePaths(cache_dir, key):
+    directory = os.path.join(cache_dir, key)
+    return os.path.join(directory, "positions.npy"), os.path.join(directory, "fractions.npy")
+
+def loadRectificationMaps(cache_dir, key):
+    # memory map the cached maps (None if they aren't cached).
+    paths = rectificationCachePaths(cache_dir, key)
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+def saveRectificationMaps(cache_dir, key, maps):
+    for path, table in zip(rectificationCachePaths(cache_dir, key), maps):
+        f.atomicSave(path, table)
+
+class Rectifier(object):
+    """
+    Rectifies the raw frames of a calibrated rig with cv2.remap. The maps
+    are computed once per calibration and kept in cache_dir, so later runs
+    only memory map them.
+    """
+
+    def __init__(self, calibration, cache_dir=None):
+        self.calibration = calibration
+        self.camera = calibration.camera
+        self.key = calibration.key()
+        maps = loadRectificationMaps(cache_dir, self.key) if cache_dir else None
+        if maps is None:
+            maps = computeRectificationMaps(calibration)
+            if cache_dir:
+                try:
+                    saveRectificationMaps(cache_dir, self.key, maps)
+                except Exception as e:
+                    print("There was an error caching the rectification maps:", e)
+        self.positions, self.fractions = maps
+
+    def rectify(self, imgL, imgR, workspace=None):
+        # the rectified pair (in the workspace buffers, if there is one).
+        if imgL.shape[:2] != self.calibration.size or imgR.shape[:2] != self.calibration.size:
+            raise ValueError("frame size " + str(imgL.shape[:2]) + " does not match the calibration " + str(self.calibration.size))
+        rectified = []
+        for i, (img, name) in enumerate(((imgL, 'rectified left'), (imgR, 'rectified right'))):
+            dst = f.scratch(workspace, name, img.shape, img.dtype)
+            rectified.append(cv2.remap(img, self.positions[i], self.fractions[i], cv2.INTER_LINEAR, dst))
+        return rectified[0], rectified[1]
+
+rectifiers = {}
+rectifiersLock = threading.Lock()
+
+def getRectifier(filename, cache_dir=None):
+    # loaded once per calibration file (None if there isn't one).
+    if not filename:
+        return None
+    key = (os.path.abspath(filename), cache_dir)
+    with rectifiersLock:
+        if key not in rectifiers:
+            rectifiers[key] = Rectifier(loadCalibration(filename), cache_dir)
+        return rectifiers[key]
@@ -0,0 +1,148 @@
+import os
+import numpy as np
+
+# a point as it is exported: position (metres), colour (RGB) and whether
+# it lies on the fitted road plane. packed s.t it is also the vertex
+# layout of the binary PLY files.
+cloud_dtype = np.dtype([('xyz', '<f4', 3), ('rgb', 'u1', 3), ('inlier', 'u1')])
+
+# one entry per frame in the store index. offsets are in records, not bytes.
+index_dtype = np.dtype([('name', 'S64'), ('frame', '<i8'),
+                        ('cloud_offset', '<i8'), ('cloud_count', '<i8'),
+                        ('mask_offset', '<i8'), ('mask_height', '<i4'), ('mask_width', '<i4')])
+
+def packCloud(points, inliers=None):
+    # the exported cloud of a point cloud from projectDisparityTo3d.
+    cloud = np.empty(len(points), cloud_dtype)
+    cloud['xyz'] = points['xyz']
+    cloud['rgb'] = points['rgb']
+    cloud['inlier'] = 0 if inliers is None else inliers
+    return cloud
+
+# -------------------------------------------------------------------
+# FRAME STORE
+# -------------------------------------------------------------------
+
+class FrameStore(object):
+    """
+    Append-only store of the clouds and road masks of a drive, in three
+    files in a directory: clouds.bin and masks.bin hold the records of
+    every frame back to back, and index.bin holds where each frame's
+    records start. A frame's data is written before its index entry, so
+    a reader never sees a partial frame. Reading memory maps the files,
+    so any frame can be read without loading the others.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.cloud_path = os.path.join(directory, "clouds.bin")
+        self.mask_path = os.path.join(directory, "masks.bin")
+        self.index_path = os.path.join(directory, "index.bin")
+        self.files = None
+
+    # ---------------------------------------------------------------
+    # writing
+    # ---------------------------------------------------------------
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.files = [open(path, 'ab') for path in (self.cloud_path, self.mask_path, self.index_path)]
+        # drop anything written after the last complete index entry.
+        index = self.index()
+        clouds, masks = 0, 0
+        if len(index) > 0:
+            last = index[-1]
+            clouds = int(last['cloud_offset'] + last['cloud_count'])
+            masks = int(last['mask_offset'] + int(last['mask_height']) * int(last['mask_width']))
+        self.files[0].truncate(clouds * cloud_dtype.itemsize)
+        self.files[1].truncate(masks)
+        self.files[2].truncate(len(index) * index_dtype.itemsize)
+        self.clouds, self.masks, self.frames = clouds, masks, len(index)
+
+    def append(self, name, cloud, mask, frame=None):
+        if self.files is None:
+            self.open()
+        cloud = np.ascontiguousarray(cloud, cloud_dtype)
+        mask = np.ascontiguousarray(mask, np.uint8)
+        entry = np.zeros(1, index_dtype)
+        entry['name'] = str(name).encode()[:64]
+        entry['frame'] = self.frames if frame is None else frame
+        entry['cloud_offset'] = self.clouds
+        entry['cloud_count'] = len(cloud)
+        entry['mask_offset'] = self.masks
+        entry['mask_height'], entry['mask_width'] = mask.shape[:2]
+        self.files[0].write(cloud.tobytes())
+        self.files[1].write(mask.tobytes())
+        self.files[0].flush()
+        self.files[1].flush()
+        self.files[2].write(entry.tobytes())
+        self.files[2].flush()
+        self.clouds += len(cloud)
+        self.masks += mask.size
+        self.frames += 1
+
+    def close(self):
+        if self.files is not None:
+            for fp in self.files:
+                fp.close()
+            self.files = None
+
+    # ---------------------------------------------------------------
+    # reading
+    # ---------------------------------------------------------------
+
+    def mapped(self, path, dtype):
+        # np.memmap can't map an empty (or missing) file.
+        if not os.path.isfile(path) or os.path.getsize(path) < dtype.itemsize:
+            return np.zeros(0, dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(os.path.getsize(path) // dtype.itemsize,))
+
+    def index(self):
+        return self.mapped(self.index_path, index_dtype)
+
+    def __len__(self):
+        return len(self.index())
+
+    def frame(self, i):
+        # (name, cloud, road mask) of the i'th frame, as memory mapped arrays.
+        entry = self.index()[i]
+        start = int(entry['cloud_offset'])
+        cloud = self.mapped(self.cloud_path, cloud_dtype)[start:start + int(entry['cloud_count'])]
+        height, width = int(entry['mask_height']), int(entry['mask_width'])
+        start = int(entry['mask_offset'])
+        mask = self.mapped(self.mask_path, np.dtype(np.uint8))[start:start + height * width].reshape((height, width))
+        return entry['name'].decode(), cloud, mask
+
+    def find(self, name):
+        # index of the frame called name (-1 if it isn't in the store).
+        matches = np.nonzero(self.index()['name'] == str(name).encode()[:64])[0]
+        return int(matches[0]) if len(matches) > 0 else -1
+
+# -------------------------------------------------------------------
+# PLY
+# -------------------------------------------------------------------
+
+def writePLY(filename, cloud):
+    # binary little endian PLY of one frame's cloud.
+    cloud = np.ascontiguousarray(cloud, cloud_dtype)
+    header = ("ply\n"
+              "format binary_little_endian 1.0\n"
+              "element vertex %d\n"
+              "property float x\n"
+              "property float y\n"
+              "property float z\n"
+              "property uchar red\n"
+              "property uchar green\n"
+              "property uchar blue\n"
+              "property uchar inlier\n"
+              "end_header\n") % len(cloud)
+    with open(filename, 'wb') as fp:
+        fp.write(header.encode('ascii'))
+        fp.write(cloud.tobytes())
+
+def readPLY(filename):
+    # reads back a cloud written by writePLY.
+    with open(filename, 'rb') as fp:
+        while fp.readline().strip() != b"end_header":
+            pass
+        return np.frombuffer(fp.read(), cloud_dtype)
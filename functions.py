@@ -2,10 +2,11 @@
 import cv2
 import math
 import numpy as np
-import random
 import os
-import colorsys
-import csv
+import hashlib
+import tempfile
+import threading
+import collections
 
 # -------------------------------------------------------------------
 # INITIALISE CONSTANTS
@@ -20,19 +21,135 @@ stereo_camera_baseline_m = 0.2090607502
 # image center point and widths
 image_centre_h = 262.0;
 image_centre_w = 474.5;
+# a rectified stereo camera: focal length and centre in pixels, baseline in metres.
+StereoCamera = collections.namedtuple('StereoCamera', ['focal_length', 'baseline', 'centre_w', 'centre_h'])
+# the camera the dataset images were rectified for (see calibration.py for other rigs).
+default_camera = StereoCamera(camera_focal_length_px, stereo_camera_baseline_m, image_centre_w, image_centre_h)
+# gamma correction applied to both images before anything else
+preprocess_gamma = 1.4;
 # maximum disparity
 max_disparity = 128;
-# initial load of stereo processor
-stereoProcessor = cv2.StereoSGBM_create(0, max_disparity, 21);
+# block size of the stereo processor
+stereo_block_size = 21;
+# SGBM modes that can be chosen from the options.
+sgbm_modes = {'sgbm': cv2.STEREO_SGBM_MODE_SGBM, 'hh': cv2.STEREO_SGBM_MODE_HH,
+              'hh4': cv2.STEREO_SGBM_MODE_HH4, '3way': cv2.STEREO_SGBM_MODE_SGBM_3WAY}
+# (matcher, disparities, block size, P1, P2, mode) of the default stereo processor
+default_matcher_settings = ('sgbm', max_disparity, stereo_block_size, 0, 0, 'sgbm')
+# stereo processors are created when first needed, once per thread.
+stereoProcessors = threading.local()
     
-# load pre-requisite masks s.t they're ready for when they are needed on an image.
-disparity_range = cv2.imread("masks/disparity_cap.png", cv2.IMREAD_GRAYSCALE)
-road_threshold_mask = cv2.imread("masks/road_threshold_mask.png", cv2.IMREAD_GRAYSCALE)
-car_front_mask = cv2.imread("masks/car_front_mask.png", cv2.IMREAD_GRAYSCALE);
-blackImg = cv2.imread("masks/black.png", cv2.IMREAD_GRAYSCALE);
-view_range = cv2.imread("masks/view_range.png", cv2.IMREAD_GRAYSCALE);
-plane_sample = cv2.imread("masks/plane_sample.png", cv2.IMREAD_GRAYSCALE);
-carmask = cv2.bitwise_and(car_front_mask, car_front_mask, mask=view_range)
+# masks live next to this file (not relative to the working directory).
+mask_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "masks")
+# rows kept and columns chopped off the left when cropping the disparity
+crop_disparity_rows = 390;
+crop_disparity_cols = 135;
+# morphology kernel used when cleaning the road image.
+road_kernel = np.ones((9,9),np.uint8)
+
+# -------------------------------------------------------------------
+# MASKS
+# -------------------------------------------------------------------
+
+class MaskRegistry(object):
+    """
+    Loads the masks on first use and caches them, along with the masks
+    derived from them, their bounding boxes and versions resized to other
+    image sizes. Sizes are (height, width), None is the size of the files.
+    """
+
+    # masks read from the mask directory
+    files = {'disparity_cap': "disparity_cap.png",
+             'road_threshold': "road_threshold_mask.png",
+             'car_front': "car_front_mask.png",
+             'view_range': "view_range.png"}
+
+    def __init__(self, directory=mask_directory):
+        self.directory = directory
+        self.cache = {}
+        self.lock = threading.RLock()
+
+    def get(self, name, size=None):
+        key = (name, None if size is None else tuple(size[:2]))
+        if key not in self.cache:
+            with self.lock:
+                if key not in self.cache:
+                    self.cache[key] = self.create(name, key[1])
+        return self.cache[key]
+
+    def create(self, name, size):
+        if size is not None and size != self.get(name).shape[:2]:
+            # resize the mask at the size of the files (never re-read it).
+            height, width = size
+            return cv2.resize(self.get(name), (width, height), interpolation=cv2.INTER_NEAREST)
+        if name in self.files:
+            mask = cv2.imread(os.path.join(self.directory, self.files[name]), cv2.IMREAD_GRAYSCALE)
+            if mask is None:
+                raise IOError("cannot read mask: " + self.files[name])
+            return mask
+        if name == 'car_view':
+            # only the road in view, without the front of the car.
+            car_front = self.get('car_front')
+            return cv2.bitwise_and(car_front, car_front, mask=self.get('view_range'))
+        if name == 'black':
+            return np.zeros_like(self.get('view_range'))
+        raise KeyError("unknown mask: " + str(name))
+
+    def region(self, name, image_size, origin, size):
+        # the mask at image_size, cropped to the size region starting at
+        # origin (the same crop as a cropped disparity).
+        key = (name, tuple(image_size[:2]), tuple(origin), tuple(size[:2]))
+        if key not in self.cache:
+            x, y = origin
+            height, width = size[:2]
+            with self.lock:
+                self.cache[key] = np.ascontiguousarray(self.get(name, image_size)[y:y + height, x:x + width])
+        return self.cache[key]
+
+    def boundingBox(self, names, size=None):
+        # bounding box (x, y, w, h) of the pixels kept by any of the masks.
+        key = ('bounding box', tuple(names), None if size is None else tuple(size[:2]))
+        if key not in self.cache:
+            combined = self.get(names[0], size)
+            for name in names[1:]:
+                combined = cv2.bitwise_or(combined, self.get(name, size))
+            self.cache[key] = cv2.boundingRect(cv2.findNonZero(combined))
+        return self.cache[key]
+
+# load pre-requisite masks when they're first needed on an image.
+masks = MaskRegistry()
+
+# -------------------------------------------------------------------
+# WORKSPACE
+# -------------------------------------------------------------------
+
+class Workspace(object):
+    """
+    Named buffers reused from frame to frame, allocated again only when the
+    size or type asked for changes. Only for the intermediate images of a
+    frame: anything kept after the frame (results, the previous disparity)
+    must never live in a workspace buffer. A workspace is used by one
+    thread at a time.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        # stereo processors owned by this workspace, by (settings, scale).
+        self.processors = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+def scratch(workspace, name, shape, dtype=np.uint8):
+    # a buffer from the workspace, or None to let opencv / numpy allocate one.
+    if workspace is None:
+        return None
+    return workspace.get(name, shape, dtype)
 
 # -------------------------------------------------------------------
 # IMAGE LOADING FUNCTIONS
@@ -58,54 +175,127 @@ def loadImages(image_paths):
 # IMAGE COLOUR MANIPULATION FUNCTIONS
 # -------------------------------------------------------------------
 
-def gammaChange(image, gamma=1.0):
+gammaTables = {}
+
+def gammaChange(image, gamma=1.0, dst=None):
     # build a lookup table mapping the pixel values to their adjusted gamma values
-    invGamma = 1.0 / gamma
-    table = np.array([((i / 255.0) ** invGamma) * 255
-        for i in np.arange(0, 256)]).astype("uint8")
+    # (once for every gamma)
+    if gamma not in gammaTables:
+        invGamma = 1.0 / gamma
+        gammaTables[gamma] = np.array([((i / 255.0) ** invGamma) * 255
+            for i in np.arange(0, 256)]).astype("uint8")
     # apply gamma correction using lookup table
-    return cv2.LUT(image, table)
+    return cv2.LUT(image, gammaTables[gamma], dst)
 
 def getPointColour(point):
     # to be used on a 3d point cloud with RGB.
-    return (point[3], point[4], point[5])
+    return tuple(point['rgb'])
 
-def BGRtoHSVHue(rgb):
-    # Converts RGB to HSV.
-    r,g,b = rgb
-    hue = round(colorsys.rgb_to_hsv(r,g,b)[0], 3)
-    # return the hue value as a string.
-    return str(hue)
+def RGBtoHSVHue(rgb):
+    # Converts an (N,3) array of RGB colours to their HSV hue (0 -> 1).
+    colours = rgb.reshape((-1,1,3)).astype(np.float32)
+    hsv = cv2.cvtColor(colours, cv2.COLOR_RGB2HSV)
+    # opencv gives the hue of float images in degrees.
+    return hsv[:,0,0] / 360.
 
-def preProcessImages(imgL,imgR):
-    images = [imgL, imgR]
-    for i in range(len(images)):
-        # adjust gamma on images.
-        images[i] = gammaChange(images[i], 1.4)
+def preProcessImages(imgL,imgR, workspace=None):
+    # adjust gamma on images. the left image is kept in the results, the
+    # right one is only needed for the disparity.
+    imgL = gammaChange(imgL, preprocess_gamma)
+    imgR = gammaChange(imgR, preprocess_gamma, scratch(workspace, 'gamma right', imgR.shape))
     # return the left and right image channels.
-    return (images[0],images[1])
+    return (imgL,imgR)
 
-def greyscale(imgL,imgR):
+def greyscale(imgL,imgR, workspace=None):
     # converts images to greyscale.
     images = [imgL, imgR]
-    for i in range(len(images)):
+    for i, name in enumerate(('grey left', 'grey right')):
         # convert greyscale
-        images[i] = cv2.cvtColor(images[i], cv2.COLOR_BGR2GRAY);
-        # equalise the histogram to improve greyscale performance
-        images[i] = cv2.equalizeHist(images[i])
+        images[i] = cv2.cvtColor(images[i], cv2.COLOR_BGR2GRAY, scratch(workspace, name, images[i].shape[:2]));
+        # equalise the histogram to improve greyscale performance (in place)
+        images[i] = cv2.equalizeHist(images[i], images[i])
     return (images[0],images[1])
 
 # -------------------------------------------------------------------
 # DISPARITY GENERATION FUNCTIONS
 # -------------------------------------------------------------------
 
+def matcherSettings(opt):
+    # the stereo processor settings from the options.
+    return (opt['stereo_matcher'], opt['max_disparity'], opt['block_size'],
+            opt['sgbm_p1'], opt['sgbm_p2'], opt['sgbm_mode'])
+
+def createStereoProcessor(settings, scale=1.0):
+    matcher, disparities, block_size, p1, p2, mode = settings
+    # for images resized by scale the disparities and block size shrink too.
+    disparities = max(16, int(round(disparities * scale / 16.)) * 16)
+    block_size = max(5 if matcher == 'bm' else 3, int(block_size * scale) | 1)
+    if matcher == 'bm':
+        return cv2.StereoBM_create(disparities, block_size)
+    elif matcher == 'sgbm':
+        return cv2.StereoSGBM_create(0, disparities, block_size, P1=p1, P2=p2, mode=sgbm_modes[mode])
+    raise ValueError("unknown stereo matcher: " + str(matcher))
+
+def getStereoProcessor(settings=default_matcher_settings, scale=1.0, workspace=None):
+    # stereo processors are never shared: they belong to the workspace they
+    # are used with, or else each thread gets its own.
+    if workspace is not None:
+        cache = workspace.processors
+    else:
+        if not hasattr(stereoProcessors, 'cache'):
+            stereoProcessors.cache = {}
+        cache = stereoProcessors.cache
+    key = (settings, scale)
+    if key not in cache:
+        cache[key] = createStereoProcessor(settings, scale)
+    return cache[key]
+
+def computeRawDisparity(grayL, grayR, roi=None, scale=1.0, settings=default_matcher_settings, workspace=None):
+    # compute the (scaled by 16) disparity, optionally only inside the roi
+    # (x, y, w, h) and/or on images resized by scale. The result is always
+    # full resolution, with no disparity outside the computed region.
+    height, width = grayL.shape[:2]
+    x0, y0, x1, y1 = 0, 0, width, height
+    if roi is not None:
+        x, y, w, h = roi
+        _, disparities, block_size, _, _, _ = settings
+        half_block = block_size // 2
+        # the search looks up to disparities pixels to the left of a pixel.
+        x0 = max(0, x - disparities - half_block)
+        y0 = max(0, y - half_block)
+        x1 = min(width, x + w + half_block)
+        y1 = min(height, y + h + half_block)
+    left = grayL[y0:y1, x0:x1]
+    right = grayR[y0:y1, x0:x1]
+    if scale != 1.0:
+        left = cv2.resize(left, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        right = cv2.resize(right, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    full_frame = (x0, y0, x1, y1) == (0, 0, width, height)
+    output = None
+    if full_frame and scale == 1.0:
+        output = scratch(workspace, 'raw disparity', (height, width), np.int16)
+    disparity = getStereoProcessor(settings, scale, workspace).compute(left, right, output)
+    if scale != 1.0:
+        # upsample, and scale the disparities back to full resolution pixels.
+        disparity = cv2.resize(disparity, (x1 - x0, y1 - y0), interpolation=cv2.INTER_NEAREST)
+        disparity = (disparity / scale).astype(np.int16)
+    if not full_frame:
+        full = scratch(workspace, 'raw disparity', (height, width), np.int16)
+        if full is None:
+            full = np.zeros((height, width), np.int16)
+        else:
+            full[:] = 0
+        full[y0:y1, x0:x1] = disparity
+        disparity = full
+    return disparity
+
 # compute disparity image from undistorted and rectified stereo images that we have loaded
 # (which for reasons best known to the OpenCV developers is returned scaled by 16)
-def disparity(grayL, grayR, max_disparity, crop_disparity):
+def disparity(grayL, grayR, max_disparity, crop_disparity, roi=None, scale=1.0, settings=default_matcher_settings, workspace=None):
     # compute disparity image from undistorted and rectified stereo images
     # that we have loaded
     # (which for reasons best known to the OpenCV developers is returned scaled by 16)
-    disparity = stereoProcessor.compute(grayL,grayR);
+    disparity = computeRawDisparity(grayL, grayR, roi, scale, settings, workspace);
     # filter out noise and speckles (adjust parameters as needed)
     dispNoiseFilter = 5; # increase for more agressive filtering
     cv2.filterSpeckles(disparity, 0, 4000, max_disparity - dispNoiseFilter);
@@ -114,120 +304,367 @@ def disparity(grayL, grayR, max_disparity, crop_disparity):
     # be 0 -> max_disparity) but in fact is (-1 -> max_disparity - 1)
     # so we fix this also using a initial threshold between 0 and max_disparity
     # as disparity=-1 means no disparity available
-    _, disparity = cv2.threshold(disparity,0, max_disparity * 16, cv2.THRESH_TOZERO);
-    disparity_scaled = (disparity / 16.).astype(np.uint8);
+    _, disparity = cv2.threshold(disparity,0, max_disparity * 16, cv2.THRESH_TOZERO, disparity);
     # crop disparity to chop out left part where there are with no disparity
     # as this area is not seen by both cameras and also
     # chop out the bottom area (where we see the front of car bonnet)
     if (crop_disparity):
-        width = np.size(disparity_scaled, 1);
-        disparity_scaled = disparity_scaled[0:390,135:width];
+        width = np.size(disparity, 1);
+        disparity = disparity[0:crop_disparity_rows,crop_disparity_cols:width];
     # display image (scaling it to the full 0->255 range based on the number
     # of disparities in use for the stereo part)
+    if 256 % max_disparity == 0:
+        # divide by 16 and scale in place, with integer shifts and multiplies.
+        np.right_shift(disparity, 4, out=disparity)
+        np.multiply(disparity, 256 // max_disparity, out=disparity)
+        disparity_scaled = np.empty(disparity.shape, np.uint8)
+        np.copyto(disparity_scaled, disparity, casting='unsafe')
+        return disparity_scaled
+    disparity_scaled = (disparity / 16.).astype(np.uint8);
     disparity_scaled = (disparity_scaled * (256. / max_disparity)).astype(np.uint8)
     return disparity_scaled
 
-def disparityCleaning(disparity, option, prev_disp=None):
+def disparityCleaning(disparity, option, prev_disp=None, plane=None, origin=(0,0), max_motion=2.0, stats=None, workspace=None,
+                      camera=default_camera, max_disparity=max_disparity):
      # compute disparity filling (for missing data)
     if option == 'previous':
         # load previous disparity to fill in missing content.
         if prev_disp is not None:
-            disparity = fillDisparity(disparity, prev_disp)
+            disparity = fillDisparity(disparity, prev_disp, workspace)
     elif option == 'mean':
         disparity = fillAltDisparity(disparity)
+    elif option == 'warp':
+        # move the previous disparity to where the car is now before filling.
+        translation = None
+        if prev_disp is not None and plane is None:
+            # without a road plane (plane_tracking off, or not found yet) the road
+            # points cannot be left out, and they pull the motion towards 0.
+            disparity = fillDisparity(disparity, prev_disp, workspace)
+        elif prev_disp is not None:
+            translation = estimateEgoMotion(disparity, prev_disp, plane, origin, max_motion, camera=camera, max_disparity=max_disparity)
+            if translation is None or not np.any(translation):
+                # no motion (or none we can measure), fill as for 'previous'.
+                disparity = fillDisparity(disparity, prev_disp, workspace)
+            else:
+                disparity = fillDisparity(disparity, warpDisparity(prev_disp, translation, origin, camera, max_disparity), workspace)
+        if stats is not None:
+            stats["Ego Motion"] = "-" if translation is None else round(float(np.linalg.norm(translation)), 3)
     return disparity
 
-def fillDisparity(disparity, previousDisparity):
+def fillDisparity(disparity, previousDisparity, workspace=None):
     if previousDisparity is not None:
-        ret, mask = cv2.threshold(disparity, 2, 255, cv2.THRESH_BINARY)
-        mask = cv2.bitwise_not(mask)
+        # the holes, i.e. where the disparity is 2 or less.
+        ret, mask = cv2.threshold(disparity, 2, 255, cv2.THRESH_BINARY_INV, scratch(workspace, 'fill mask', disparity.shape))
         # Take only region of logo from logo image.
-        filling = cv2.bitwise_and(previousDisparity,previousDisparity,mask = mask)
+        filling = scratch(workspace, 'filling', disparity.shape)
+        if filling is not None:
+            filling[:] = 0
+        filling = cv2.bitwise_and(previousDisparity,previousDisparity,filling,mask = mask)
         disparity = cv2.add(disparity,filling)
     return disparity
 
 def fillAltDisparity(disparity):
-    # get non-black points in image
-    averagePoints = []
-    for i in disparity:
-        mean = i[i.nonzero()].mean()
-        if np.isnan(mean):
-            mean = 0.0
-        averagePoints.append(mean)
-    # fill empty points with the mean.
-    for i in range(len(disparity)):
-        for j in range(len(disparity[i])):
-            if disparity[i][j] < 2:
-                disparity[i][j] = averagePoints[i]
-    return disparity
+    # mean of the non-black points on every row.
+    valid = disparity > 0
+    counts = np.count_nonzero(valid, axis=1)
+    sums = disparity.sum(axis=1, dtype=np.float64)
+    averagePoints = np.zeros(len(disparity))
+    np.divide(sums, counts, out=averagePoints, where=counts > 0)
+    # fill empty points with the mean of their row.
+    return np.where(disparity < 2, averagePoints.astype(disparity.dtype)[:, None], disparity)
+
+def roadDirection(plane):
+    # unit direction the car drives in: the optical axis flattened onto the road.
+    forward = np.array([0., 0., 1.])
+    if plane is None:
+        return forward
+    normal = np.ravel(plane) / np.linalg.norm(plane)
+    direction = forward - np.dot(forward, normal) * normal
+    return direction / np.linalg.norm(direction)
+
+def warpDisparity(disparity, translation, origin=(0,0), camera=default_camera, max_disparity=max_disparity, step=2):
+    """
+    Forward warps a disparity to a camera moved by translation (metres, in
+    the camera frame). Nearer points win where several land on one pixel.
+    Only every step'th pixel is moved, the gaps are closed afterwards.
+    """
+    height, width = disparity.shape[:2]
+    tables = getProjectionTables((height, width), origin, camera, max_disparity)
+    sampled = disparity[0:height:step, 0:width:step]
+    ys, xs = np.nonzero(sampled)
+    values = sampled[ys, xs]
+    X, Y, Z = tables.project(ys * step, xs * step, values)
+    X = X - translation[0]
+    Y = Y - translation[1]
+    Z = Z - translation[2]
+    # drop everything the car has driven past.
+    ahead = Z > 0.5
+    X, Y, Z = X[ahead], Y[ahead], Z[ahead]
+    u, v, values = tables.reproject(X, Y, Z)
+    u = np.rint(u).astype(np.intp)
+    v = np.rint(v).astype(np.intp)
+    values = np.clip(np.rint(values), 1, 255).astype(disparity.dtype)
+    inside = (u >= 0) & (u < width) & (v >= 0) & (v < height)
+    warped = np.zeros_like(disparity)
+    np.maximum.at(warped.ravel(), v[inside] * width + u[inside], values[inside])
+    # close the gaps between the samples (and the cracks left by the
+    # points spreading out as we get closer).
+    grown = cv2.dilate(warped, np.ones((step + 1, step + 1), np.uint8))
+    return np.where(warped == 0, grown, warped)
+
+def egoMotionErrors(distances, X, Y, Z, direction, disparity, tables):
+    # how badly the points moved by each distance agree with the disparity.
+    height, width = disparity.shape[:2]
+    errors = np.full(len(distances), np.inf)
+    for i, distance in enumerate(distances):
+        t = direction * distance
+        Zt = Z - t[2]
+        u, v, predicted = tables.reproject(X - t[0], Y - t[1], np.maximum(Zt, 1e-3))
+        u = np.rint(u).astype(np.intp)
+        v = np.rint(v).astype(np.intp)
+        inside = (u >= 0) & (u < width) & (v >= 0) & (v < height) & (Zt > 0.5)
+        observed = disparity[v[inside], u[inside]].astype(np.float32)
+        predicted = predicted[inside]
+        valid = observed >= 2
+        if np.count_nonzero(valid) == 0:
+            continue
+        # truncated error s.t moving objects don't decide the motion.
+        errors[i] = np.minimum(np.abs(observed[valid] - predicted[valid]), 8).mean()
+    return errors
+
+def estimateEgoMotion(disparity, previousDisparity, plane=None, origin=(0,0), max_motion=2.0, candidates=9, step=4, road_margin=0.1,
+                      camera=default_camera, max_disparity=max_disparity, min_contrast=0.2):
+    """
+    Estimates how far the car moved along the road since the previous
+    disparity, by moving a sample of its points along the road direction
+    and keeping the distance that best agrees with the current disparity.
+    The best of a coarse grid of distances is refined on a finer grid
+    around it. Returns None if no distance is clearly better than the
+    others (e.g. there is nothing near enough off the road to tell).
+    """
+    height, width = disparity.shape[:2]
+    tables = getProjectionTables((height, width), origin, camera, max_disparity)
+    direction = roadDirection(plane)
+    sampled = previousDisparity[0:height:step, 0:width:step]
+    ys, xs = np.nonzero(sampled)
+    ys, xs = ys * step, xs * step
+    X, Y, Z = tables.project(ys, xs, previousDisparity[ys, xs])
+    if plane is not None:
+        # the road looks the same wherever we are on it, so only the
+        # points off the road tell us how far we moved.
+        a, b, c = np.ravel(plane)
+        off = np.abs(a * X + b * Y + c * Z - 1) > road_margin * np.linalg.norm(plane)
+        X, Y, Z = X[off], Y[off], Z[off]
+    # and only the points near enough for the motion to change their disparity.
+    _, _, before = tables.reproject(X, Y, Z)
+    _, _, after = tables.reproject(X, Y, np.maximum(Z - max_motion, 0.5))
+    near = after - before >= 1
+    if np.count_nonzero(near) == 0:
+        return None
+    X, Y, Z = X[near], Y[near], Z[near]
+    coarse = np.linspace(0, max_motion, candidates)
+    errors = egoMotionErrors(coarse, X, Y, Z, direction, disparity, tables)
+    best = np.argmin(errors)
+    typical = np.median(errors[np.isfinite(errors)]) if np.any(np.isfinite(errors)) else np.inf
+    if not np.isfinite(errors[best]) or typical - errors[best] < min_contrast * typical:
+        return None
+    # refine between the neighbours of the best coarse distance.
+    spacing = coarse[1] - coarse[0] if candidates > 1 else max_motion
+    fine = np.linspace(max(0, coarse[best] - spacing), min(max_motion, coarse[best] + spacing), candidates)
+    errors = egoMotionErrors(fine, X, Y, Z, direction, disparity, tables)
+    return direction * fine[np.argmin(errors)]
 
-def capDisparity(disparity):
+def applyMask(disparity, name, dst=None, origin=(0,0), image_size=None):
+    # keep the disparity where the mask is set (zero everywhere else).
+    # a disparity cropped out of an image_size image at origin gets the same crop of the mask.
+    if image_size is None:
+        mask = masks.get(name, disparity.shape)
+    else:
+        mask = masks.region(name, image_size, origin, disparity.shape)
+    if dst is not None:
+        dst[:] = 0
+    return cv2.bitwise_and(disparity,disparity,dst,mask = mask)
+
+def capDisparity(disparity, workspace=None, origin=(0,0), image_size=None):
     # only keep the road range.
-    cv2.bitwise_and(disparity,disparity,mask = disparity_range)
-    return disparity
+    return applyMask(disparity, 'disparity_cap', scratch(workspace, 'capped disparity', disparity.shape), origin, image_size)
 
-def maskDisparity(disparity):
+def maskDisparity(disparity, workspace=None, origin=(0,0), image_size=None):
     # Take only a particular region (remove car parts)
-    disparity = cv2.bitwise_and(disparity,disparity,mask = carmask)
-    return disparity
+    return applyMask(disparity, 'car_view', scratch(workspace, 'masked disparity', disparity.shape), origin, image_size)
+
+# -------------------------------------------------------------------
+# DISPARITY CACHE
+# -------------------------------------------------------------------
+
+def disparityCacheKey(max_disparity, crop_disparity, roi=None, scale=1.0, settings=default_matcher_settings, rectification=None):
+    # everything that changes the output of disparity() for the same frame.
+    settings = (roi, scale, settings, max_disparity, bool(crop_disparity),
+        preprocess_gamma, 'equalizeHist')
+    if rectification is not None:
+        # the raw frames were rectified with this calibration first.
+        settings += (rectification,)
+    return hashlib.sha1(repr(settings).encode()).hexdigest()[:16]
+
+def disparityCachePath(cache_dir, key, filename):
+    # one file per frame, grouped by the settings they were computed with.
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(cache_dir, key, name + ".npy")
+
+def loadCachedDisparity(path):
+    # memory map the disparity (copy on write, s.t cleaning it never touches the cache)
+    if os.path.isfile(path):
+        return np.load(path, mmap_mode='c')
+    return None
+
+def atomicSave(path, array):
+    # write to a temporary file first s.t readers never see a partial array.
+    # the temporary name is unique s.t several writers of the same path (the
+    # batch workers share their overlap frames) never write into one file.
+    directory = os.path.dirname(path)
+    os.makedirs(directory or ".", exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory or ".", suffix=".tmp.npy")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            np.save(temp_file, array)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def saveCachedDisparity(path, disparity):
+    atomicSave(path, disparity)
 
 # -------------------------------------------------------------------
 # 3D CALCULATIONS
 # -------------------------------------------------------------------
 
-def projectDisparityTo3d(disparity, max_disparity, rgb=[]):
-    # list of points
-    points = [];
-    f = camera_focal_length_px;
-    B = stereo_camera_baseline_m;
-    height, width = disparity.shape[:2];
+class ProjectionTables(object):
+    """
+    Everything needed to project a disparity image of a given size to 3D
+    without any division per frame: the (x - cx)/f of every column, the
+    (y - cy)/f of every row and the Z (metres) of each of the 256 values of
+    an 8-bit disparity from disparity(), which is scaled by 256/max_disparity.
+    """
+
+    def __init__(self, size, origin=(0,0), camera=default_camera, max_disparity=max_disparity):
+        height, width = size
+        self.camera = camera
+        self.origin = origin
+        f = camera.focal_length;
+        B = camera.baseline;
+        # origin is where pixel (0,0) of the (possibly cropped) disparity is in the image.
+        self.gx = ((np.arange(width) + origin[0] - camera.centre_w) / f).astype(np.float32)
+        self.gy = ((np.arange(height) + origin[1] - camera.centre_h) / f).astype(np.float32)
+        # pixels of disparity per step of the 8-bit disparity.
+        self.step = max_disparity / 256.
+        # Z = f*B/disparity, with no point for a disparity of 0.
+        with np.errstate(divide='ignore'):
+            self.z = (f * B / (np.arange(256, dtype=np.float64) * self.step)).astype(np.float32)
+        self.z[0] = 0
+
+    def project(self, ys, xs, values):
+        # (N,3) XYZ of the pixels (ys, xs) with 8-bit disparities values.
+        Z = self.z[values]
+        return self.gx[xs] * Z, self.gy[ys] * Z, Z
+
+    def reproject(self, X, Y, Z):
+        # the (x, y) pixel and 8-bit disparity (unrounded) of points in front of the camera.
+        f = self.camera.focal_length
+        u = X * f / Z + self.camera.centre_w - self.origin[0]
+        v = Y * f / Z + self.camera.centre_h - self.origin[1]
+        return u, v, f * self.camera.baseline / (Z * self.step)
+
+projectionTables = {}
+
+def getProjectionTables(size, origin=(0,0), camera=default_camera, max_disparity=max_disparity):
+    # built once per camera, image size, crop and disparity range.
+    key = (tuple(size[:2]), tuple(origin), camera, max_disparity)
+    if key not in projectionTables:
+        projectionTables[key] = ProjectionTables(size[:2], origin, camera, max_disparity)
+    return projectionTables[key]
+
+def disparityOrigin(crop_disparity):
+    # where pixel (0,0) of the disparity lies in the image.
+    return (crop_disparity_cols, 0) if crop_disparity else (0, 0)
 
-    for y in range(0,height-1, 2): # 0 - height is the y axis index
-        for x in range(0,width-1, 2): # 0 - width is the x axis index
-            # if we have a valid non-zero disparity
-            if (disparity[y,x] > 0):
-                # calculate corresponding 3D point [X, Y, Z]
-                # stereo lecture - slide 22 + 25
-                Z = (f * B) / disparity[y,x];
-                X = ((x - image_centre_w) * Z) / f;
-                Y = ((y - image_centre_h) * Z) / f;
-                if(len(rgb) > 0):
-                    points.append([X,Y,Z,rgb[y,x,2], rgb[y,x,1],rgb[y,x,0]]);
-                else:
-                    points.append([X,Y,Z]);
+# columnar layout of a point cloud; xyz is in metres, rgb is in RGB order
+# and uv is the (x,y) pixel the point was projected from.
+point_dtype = np.dtype([('xyz', np.float32, 3), ('rgb', np.uint8, 3), ('uv', np.int32, 2)])
+
+def projectDisparityTo3d(disparity, max_disparity, rgb=[], step=2, origin=(0,0), camera=default_camera):
+    height, width = disparity.shape[:2];
+    tables = getProjectionTables((height, width), origin, camera, max_disparity)
+    # sample every step'th pixel (0 - height is the y axis index,
+    # 0 - width is the x axis index)
+    sampled = disparity[0:height-1:step, 0:width-1:step]
+    # we only keep points that have a valid non-zero disparity
+    ys, xs = np.nonzero(sampled)
+    values = sampled[ys, xs]
+    ys = ys * step
+    xs = xs * step
+    points = np.empty(len(values), dtype=point_dtype)
+    # calculate corresponding 3D point [X, Y, Z]
+    # stereo lecture - slide 22 + 25
+    xyz = points['xyz']
+    xyz[:, 0], xyz[:, 1], xyz[:, 2] = tables.project(ys, xs, values)
+    # keep the pixel indices s.t we never have to project back to 2D.
+    points['uv'][:, 0] = xs
+    points['uv'][:, 1] = ys
+    if(len(rgb) > 0):
+        # image is BGR, store the colours as RGB.
+        points['rgb'] = rgb[ys + origin[1], xs + origin[0], ::-1]
+    else:
+        points['rgb'] = 0
     return points;
 
+def planeDistanceImage(disparity, abc, origin=(0,0), camera=default_camera, max_disparity=max_disparity, step=1):
+    # distance of every step'th pixel of the disparity from the plane abc
+    # (infinite where there is no disparity).
+    tables = getProjectionTables(disparity.shape, origin, camera, max_disparity)
+    sampled = disparity[::step, ::step]
+    a, b, c = np.ravel(abc)
+    Z = tables.z[sampled]
+    # a*X + b*Y + c*Z = Z * (a*gx + b*gy + c)
+    dist = np.abs(Z * (a * tables.gx[None, ::step] + b * tables.gy[::step, None] + c) - 1)
+    dist *= np.float32(1. / np.linalg.norm(abc))
+    dist[sampled == 0] = np.inf
+    return dist
+
+def getPointCoordinates(points):
+    # returns an (N,3) view of the XYZ coordinates of a point cloud.
+    if points.dtype.names is not None:
+        return points['xyz']
+    return points[:, :3]
+
 # project a set of 3D points back the 2D image domain
-def project3DPointsTo2DImagePoints(points):
-    pts = [];
-    for i1 in range(len(points)):
-        # reverse earlier projection for X and Y to get x and y again
-        Z = points[i1][2]
-        x = ((points[i1][0] * camera_focal_length_px) / Z) + image_centre_w;
-        y = ((points[i1][1] * camera_focal_length_px) / Z) + image_centre_h;
-        pts.append([x,y]);
+def project3DPointsTo2DImagePoints(points, camera=default_camera):
+    xyz = getPointCoordinates(points)
+    # reverse earlier projection for X and Y to get x and y again
+    Z = xyz[:, 2]
+    pts = np.empty((len(xyz), 2), dtype=np.float32)
+    pts[:, 0] = ((xyz[:, 0] * camera.focal_length) / Z) + camera.centre_w;
+    pts[:, 1] = ((xyz[:, 1] * camera.focal_length) / Z) + camera.centre_h;
     return pts;
 
 # -------------------------------------------------------------------
 # HISTOGRAM FUNCTIONS
 # -------------------------------------------------------------------
 
-def calculateColourHistogram(points):
-    # get colour points for each point in plane.
-    # convert it to greyscale
-    colours = [BGRtoHSVHue((pt[3],pt[4],pt[5])) for pt in points]
-    # print(colours)
-    histogram = {}
-    for i in colours:
-        if i not in histogram:
-            histogram[i] = 1
-        else:
-            histogram[i] += 1
-    return histogram
+def binPointHues(points, bins=1000):
+    # compute the hue of every point once, and bin it to a fixed width.
+    # (1000 bins is equivalent to rounding the hue to 3 decimal places)
+    hues = RGBtoHSVHue(points['rgb'])
+    return np.rint(hues * bins).astype(np.intp)
 
-def filterPointsByHistogram(points, histogram, threshold=100):
-    # pythonic expression for filtering points by histogram
-    return [x for x in points if histogram[BGRtoHSVHue(getPointColour(x))] > threshold]
+def calculateColourHistogram(binned, bins=1000):
+    # count the points in each hue bin (a hue of 1.0 rounds into the extra bin).
+    return np.bincount(binned, minlength=bins + 1)
+
+def filterPointsByHistogram(points, histogram, binned, threshold=100):
+    # only keep points whose hue is populous enough.
+    return points[histogram[binned] > threshold]
 
 def calculateHistogram(img):
     hist = cv2.calcHist([img],[0],None,[256],[0,256])
@@ -237,74 +674,163 @@ def calculateHistogram(img):
 # RANSAC
 # -------------------------------------------------------------------
 
-def randomNonCollinearPoints(points):
-    cross_product_check = np.array([0,0,0]);
-    # cross product checks
-    cp_check0 = True if cross_product_check[0] == 0 else False
-    cp_check1 = True if cross_product_check[1] == 0 else False
-    cp_check2 = True if cross_product_check[2] == 0 else False
-    
-    P1 = None
-    P2 = None
-    P3 = None
-
-    while cp_check0 and cp_check1 and cp_check2:
-        P1 = np.array([x[:3] for x in random.sample(points, 1)])[0]
-        P2 = np.array([x[:3] for x in random.sample(points, 1)])[0]
-        P3 = np.array([x[:3] for x in random.sample(points, 1)])[0]
-        # make sure they are non-collinear
-        cross_product_check = np.cross(P1-P2, P2-P3)
-        cp_check0 = True if cross_product_check[0] == 0 else False
-        cp_check1 = True if cross_product_check[1] == 0 else False
-        cp_check2 = True if cross_product_check[2] == 0 else False
-    return (P1, P2, P3)
-
-def planarFitting(randomPoints, points):
-    # generate random colinear points.
-    # Here we choose from the whole point range
-    P1, P2, P3 = randomNonCollinearPoints(points)
-    # calculate coefficents a,b, and c
-    abc = np.dot(np.linalg.inv(np.array([P1,P2,P3])), np.ones([3,1]))
-    # calculate coefficents d
-    d = math.sqrt(abc[0]*abc[0]+abc[1]*abc[1]+abc[2]*abc[2])
-    # make sure we have random points
-    if len(randomPoints[0]) > 3:
-        randomPoints = [[item[0], item[1], item[2]] for item in randomPoints]
-    # measure distance of our random points from plane given 
-    # the plane coefficients calculated
-    dist = abs((np.dot(randomPoints, abc) - 1)/d)
-    return abc, abc, dist
+def randomNonCollinearPoints(points, count, random=np.random):
+    # draw all the minimal samples (3 points each) at once.
+    xyz = getPointCoordinates(points)
+    samples = xyz[random.randint(0, len(xyz), (count, 3))].astype(np.float64)
+    # make sure they are non-collinear
+    cross_product_check = np.cross(samples[:,0]-samples[:,1], samples[:,1]-samples[:,2])
+    valid = np.any(cross_product_check != 0, axis=1)
+    return samples[valid]
+
+def planarFitting(samples):
+    # solve every plane a*X + b*Y + c*Z = 1 through its three points at once.
+    # the normal of each plane comes from the cross product of its edges
+    # which (unlike inverting the point matrix) never raises on degenerate samples.
+    P1, P2, P3 = samples[:,0], samples[:,1], samples[:,2]
+    normals = np.cross(P2 - P1, P3 - P1)
+    offsets = np.einsum('ij,ij->i', normals, P1)
+    # planes through the camera centre cannot be written in this form.
+    valid = np.abs(offsets) > 1e-12
+    return normals[valid] / offsets[valid, None]
+
+def ransacTrialsRequired(inlier_ratio, confidence, sample_size=3):
+    # standard bound on the number of trials needed to draw an all inlier
+    # sample with the given confidence.
+    good_sample = inlier_ratio ** sample_size
+    if good_sample <= 0:
+        return float("inf")
+    if good_sample >= 1:
+        return 0
+    return math.log(1 - confidence) / math.log(1 - good_sample)
+
+def refitPlane(xyz):
+    # least squares plane (a*X + b*Y + c*Z = 1) through a set of points.
+    abc, _, _, _ = np.linalg.lstsq(xyz, np.ones(len(xyz)), rcond=None)
+    return abc.reshape((3,1))
 
-def RANSAC(points, trials):
+def scorePlanes(T, coefficients, threshold):
+    # distance of every sample point from every plane, in one product.
+    dist = np.abs(np.dot(T, coefficients.T) - 1) / np.linalg.norm(coefficients, axis=1)
+    # truncated error s.t outliers do not dominate the score.
+    return dist, np.minimum(dist, threshold).mean(axis=0)
+
+def RANSAC(points, trials, threshold=0.05, confidence=0.99, stats=None,
+           sample_size=600, batch_size=100, initial=None, random=np.random):
+    # random is np.random, or a np.random.RandomState for repeatable planes.
     # init variables
-    bestPlane = (None, None)
-    bestError = float("inf")
-    # compute plane.
-    for i in range(trials):
-        # select T data points randomly
-        try:
-            T = random.sample(points, 600)
-            # estimate the plane using this subset of information
-            coefficents, normal, dist = planarFitting(T, points)
-            error = np.mean(dist)
-            # store the results in our dictionary.
-            if error < bestError:
-                bestPlane = (normal,coefficents)
-                bestError = error
-        except Exception as e:
-            # probably found some random error in terms of singular matrix.
-            pass
+    bestPlane = None
+    xyz = getPointCoordinates(points).astype(np.float64)
+    if len(xyz) < 3:
+        return (None, None)
+    # select T data points randomly, every hypothesis is scored against them.
+    T = xyz[random.choice(len(xyz), min(sample_size, len(xyz)), replace=False)]
+    bestScore = float("inf")
+    bestInliers = 0
+    required = trials
+    done = 0
+    if initial is not None:
+        # score the initial plane first, a good one cuts the trials needed.
+        dist, scores = scorePlanes(T, np.reshape(initial, (1,3)), threshold)
+        bestScore = scores[0]
+        bestPlane = np.reshape(initial, (3,1))
+        bestInliers = np.count_nonzero(dist[:, 0] < threshold)
+        required = ransacTrialsRequired(bestInliers / len(T), confidence)
+    # compute planes in batches until we are confident enough we have seen
+    # an all inlier sample (or we run out of trials).
+    while done < min(trials, required):
+        count = min(batch_size, trials - done, int(math.ceil(min(trials, required) - done)))
+        done += count
+        coefficients = planarFitting(randomNonCollinearPoints(xyz, count, random))
+        if len(coefficients) == 0:
+            continue
+        dist, scores = scorePlanes(T, coefficients, threshold)
+        best = np.argmin(scores)
+        if scores[best] < bestScore:
+            bestScore = scores[best]
+            bestPlane = coefficients[best].reshape((3,1))
+            bestInliers = np.count_nonzero(dist[:, best] < threshold)
+            required = ransacTrialsRequired(bestInliers / len(T), confidence)
+    if bestPlane is None:
+        return (None, None)
+    # finish with a least squares refit on all inliers of the best plane.
+    inliers = xyz[calculatePointErrors(bestPlane, xyz).ravel() < threshold]
+    if len(inliers) >= 3:
+        bestPlane = refitPlane(inliers)
+    if stats is not None:
+        inlier_ratio = bestInliers / len(T)
+        stats["RANSAC Trials"] = done
+        stats["RANSAC Inlier Ratio"] = round(float(inlier_ratio), 4)
+        stats["RANSAC Confidence"] = round(float(1 - (1 - inlier_ratio ** 3) ** done), 4)
     # return the best plane.
-    return bestPlane
+    return (bestPlane, bestPlane)
+
+class PlaneTracker(object):
+    """
+    Carries the road plane across frames. The previous plane is used as the
+    first RANSAC hypothesis, and while it still explains the points RANSAC
+    only runs a reduced number of trials on a random subset of sample_points
+    points (most of its time is the refit over the whole cloud, not the
+    trials). The plane is smoothed with an exponential filter on its unit
+    normal and distance, and is reset by a full search when tracking is lost.
+    """
+
+    def __init__(self, refine_fraction=0.1, smoothing=0.5, lost_ratio=0.8, sample_points=3000):
+        self.refine_fraction = refine_fraction
+        self.smoothing = smoothing
+        self.lost_ratio = lost_ratio
+        self.sample_points = sample_points
+        self.normal = None
+        self.distance = None
+        self.inlier_ratio = None
+
+    def plane(self):
+        if self.normal is None:
+            return None
+        return (self.normal / self.distance).reshape((3,1))
+
+    def fit(self, points, trials, threshold=0.05, confidence=0.99, stats=None, random=np.random):
+        stats = stats if stats is not None else {}
+        initial = self.plane()
+        if initial is not None:
+            # check the previous plane still explains the points.
+            xyz = getPointCoordinates(points)
+            sample = xyz[random.randint(0, len(xyz), min(600, len(xyz)))]
+            ratio = np.count_nonzero(calculatePointErrors(initial, sample) < threshold) / float(max(len(sample), 1))
+            if ratio >= self.lost_ratio * self.inlier_ratio:
+                trials = max(1, int(trials * self.refine_fraction))
+                # a few thousand points pin down a plane we already know.
+                if len(points) > self.sample_points:
+                    points = points[random.randint(0, len(points), self.sample_points)]
+            else:
+                initial = None
+        stats["Plane Tracked"] = int(initial is not None)
+        normal, abc = RANSAC(points, trials, threshold, confidence, stats, initial=initial, random=random)
+        if abc is None:
+            return (None, None)
+        self.update(abc, initial is not None)
+        self.inlier_ratio = stats["RANSAC Inlier Ratio"]
+        plane = self.plane()
+        return (plane, plane)
+
+    def update(self, abc, tracked):
+        # plane a*X + b*Y + c*Z = 1 has unit normal abc/|abc| at distance 1/|abc|.
+        norm = np.linalg.norm(abc)
+        normal = np.ravel(abc) / norm
+        distance = 1. / norm
+        if not tracked:
+            self.normal, self.distance = normal, distance
+            return
+        a = self.smoothing
+        normal = (1 - a) * self.normal + a * normal
+        self.normal = normal / np.linalg.norm(normal)
+        self.distance = (1 - a) * self.distance + a * distance
 
 def calculatePointErrors(abc, points):
-    # rearrange points s.t we can perform matrix operations on them.
-    the_list = []
-    for i in points:
-        the_list.append([i[0],i[1],i[2]])
-    points = np.array(the_list)
+    # use the coordinates directly s.t we can perform matrix operations on them.
+    points = getPointCoordinates(points)
     # calculate coefficents d
-    d = math.sqrt(abc[0]*abc[0]+abc[1]*abc[1]+abc[2]*abc[2])
+    d = np.linalg.norm(abc)
     # measure distance of all points from plane given 
     # the plane coefficients calculated
     dist = abs((np.dot(points, abc) - 1)/d)
@@ -315,20 +841,20 @@ def computePlanarThreshold(points,differences,threshold=0.01):
     """
     Discards points on the disparity where it is not within the plane.
     """
-    new_points = []
-    for i in range(len(points)):
-        # we only keep points that are within the threshold.
-        if differences[i] < threshold:
-            new_points.append(points[i])
-    return new_points
+    # we only keep points that are within the threshold.
+    return points[np.ravel(differences) < threshold]
 
 # -------------------------------------------------------------------
 # POST RANSAC POINT COLOURING & FILTERING
 # automatically adjusting the parameters initial region of interest extraction or image prefiltering based on some form of preliminary analysis image
 # -------------------------------------------------------------------
 
+def findExternalContours(image):
+    # opencv 3 returns (image, contours, hierarchy), later versions drop the image.
+    return cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
 def removeSmallParticles(image, threshold=20):
-    _, contours, _= cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = findExternalContours(image)
     for spectacle in contours:
         area = cv2.contourArea(spectacle)
         if area < threshold:
@@ -336,34 +862,32 @@ def removeSmallParticles(image, threshold=20):
             cv2.drawContours(image,[spectacle],0,0,-1)
     return image
 
-def generatePointsAsImage(points):
-    img = blackImg.copy()
+def generatePointsAsImage(points, size=None):
+    img = getBlackImage(size)
     # draw points on image.
-    for i in points:
-        img[i[0][1]][i[0][0]] = 255
+    img[points[:,0,1], points[:,0,0]] = 255
     return img
 
-def sanitiseRoadImage(img, size):
-    (height, width) = size
-    referenceImg = img.copy()
+def sanitiseRoadImage(img, workspace=None, origin=(0,0), image_size=None):
     # perform closing on the image to fill holes
-    kernel = np.ones((9,9),np.uint8)
-    img = cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernel)
+    img = cv2.morphologyEx(img, cv2.MORPH_CLOSE, road_kernel, scratch(workspace, 'road closed', img.shape))
     # erode a little bit.
-    img = cv2.erode(img,kernel,iterations = 2)
+    img = cv2.erode(img,road_kernel,scratch(workspace, 'road eroded', img.shape),iterations = 2)
     # put a threshold for the road points (used for convex hull purposes)
-    img = cv2.bitwise_and(img,img,mask = road_threshold_mask)
-    img = cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernel)
+    img = applyMask(img, 'road_threshold', scratch(workspace, 'road closed', img.shape), origin, image_size)
+    # the cleaned image is kept in the results, so it gets its own array.
+    img = cv2.morphologyEx(img, cv2.MORPH_CLOSE, road_kernel)
     # remove small particles manually
-    img = ParticleCleansing(img)
-    pts = []
-    for i in range(height):
-        for j in range(width):
-            if img[i][j] != 0:
-                k = [j,i]
-                pts.append(k)
-    pts = np.matrix(pts)
-    return img, pts
+    contours = findExternalContours(img)
+    img = ParticleCleansing(img, contours)
+    # the hull of the outlines is the hull of every road pixel.
+    return img, getRoadHull(contours)
+
+def getRoadHull(contours):
+    # compute the convex hull around a list of contours.
+    if len(contours) == 0:
+        return None
+    return cv2.convexHull(np.concatenate(contours))
 
 def generatePlaneShape(points, copy):
     img = cv2.cvtColor(copy,cv2.COLOR_BGR2GRAY)
@@ -375,43 +899,103 @@ def generatePlaneShape(points, copy):
     img = ParticleCleansing(img)
     return img
 
-def ParticleCleansing(image):
-	_, contours, _= cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+def ParticleCleansing(image, contours=None):
+	if contours is None:
+		contours = findExternalContours(image)
 	for spot in contours:
 		area = cv2.contourArea(spot)
 		if area < 70:
 			cv2.drawContours(image,[spot],0,255,-100)
 	return image
 
+# -------------------------------------------------------------------
+# OBSTACLES
+# -------------------------------------------------------------------
+
+# an obstacle found in the obstacle mask: bbox is (x, y, w, h) in pixels,
+# area is in pixels, distance is the median Z (metres) of its pixels and
+# height is how far its top stands above the road plane (metres).
+Obstacle = collections.namedtuple('Obstacle', ['bbox', 'area', 'distance', 'height'])
+
+def groupPercentiles(groups, values, count, q):
+    # the q'th percentile of the values of every group 1 -> count - 1 (nan if empty).
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    sizes = np.bincount(groups, minlength=count)
+    starts = np.cumsum(sizes) - sizes
+    result = np.full(count, np.nan, np.float32)
+    filled = sizes > 0
+    result[filled] = values[starts[filled] + ((sizes[filled] - 1) * q) // 100]
+    return result
+
+def findObstacles(obstacleMask, disparity, abc=None, origin=(0,0), min_area=20, camera=default_camera, max_disparity=max_disparity):
+    """
+    Splits the single channel obstacle mask into its connected components
+    and measures each one from the disparity (and the road plane abc).
+    Returns a list of Obstacles, nearest first.
+    """
+    count, labels, componentStats, _ = cv2.connectedComponentsWithStats(obstacleMask, connectivity=8)
+    # only the pixels with a disparity can be measured.
+    ys, xs = np.nonzero((labels > 0) & (disparity > 0))
+    groups = labels[ys, xs]
+    X, Y, Z = getProjectionTables(disparity.shape, origin, camera, max_disparity).project(ys, xs, disparity[ys, xs])
+    distances = groupPercentiles(groups, Z, count, 50)
+    heights = np.full(count, np.nan, np.float32)
+    if abc is not None:
+        # signed distance from the plane, positive on the camera side.
+        a, b, c = np.ravel(abc)
+        above = (1 - (a * X + b * Y + c * Z)) / np.linalg.norm(abc)
+        # the 95th percentile s.t a few bad disparities don't decide the top.
+        heights = groupPercentiles(groups, above.astype(np.float32), count, 95)
+    obstacles = []
+    for label in range(1, count):
+        x, y, w, h, area = componentStats[label]
+        if area < min_area or np.isnan(distances[label]):
+            continue
+        obstacles.append(Obstacle((int(x), int(y), int(w), int(h)), int(area),
+                                  float(distances[label]), float(heights[label])))
+    obstacles.sort(key=lambda obstacle: obstacle.distance)
+    return obstacles
+
 # -------------------------------------------------------------------
 # CONTOURS AND NORMAL LINES
 # -------------------------------------------------------------------
 
-def drawRoadLine(image, points):
-    # generate convex hull
-    hull = cv2.convexHull(points)
+def drawObstacles(image, obstacleMask, alpha=0.4):
+    # tint the obstacle pixels yellow (only those pixels are touched).
+    region = obstacleMask > 0
+    image[region] = image[region] * (1 - alpha) + np.array([0,255,255]) * alpha
+    return image
+
+def drawObstacleBoxes(image, obstacles):
+    # box every obstacle and label it with its distance.
+    for obstacle in obstacles:
+        x, y, w, h = obstacle.bbox
+        cv2.rectangle(image, (x, y), (x + w, y + h), (0,255,255), 1)
+        cv2.putText(image, "%.1fm" % obstacle.distance, (x, max(y - 3, 10)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0,255,255), 1)
+    return image
+
+def drawRoadLine(image, hull):
     # draw hull on image
-    return (cv2.drawContours(image,[hull],0,(0,0,255),5), hull)
+    return cv2.drawContours(image,[hull],0,(0,0,255),5)
 
-def getNormalVectorLine(basePoint, abc, disparity):
-    # basepoint is x,y
+def getNormalVectorLine(basePoint, abc, disparity, camera=default_camera, max_disparity=max_disparity, origin=(0,0)):
+    # basepoint is x,y (in the disparity, which starts at origin in the image)
     x,y = basePoint
-    f = camera_focal_length_px;
-    B = stereo_camera_baseline_m;
     # calculate X,Y,Z
-    Z = (f * B) / disparity[y,x];
-    X = ((x - image_centre_w) * Z) / f;
-    Y = ((y - image_centre_h) * Z) / f;
+    X, Y, Z = getProjectionTables(disparity.shape, origin, camera, max_disparity).project(y, x, disparity[y,x])
     # increment Y.
     newY = Y - 0.7
     newX = X + 0.0
     # calculate D
-    d = math.sqrt(abc[0]*abc[0]+abc[1]*abc[1]+abc[2]*abc[2])
+    d = np.linalg.norm(abc)
     # calculate new Z
-    Z = d - ((abc[0] * newX) + (abc[1]*newY))
+    a, b, _ = np.ravel(abc)
+    Z = d - ((a * newX) + (b*newY))
     # convert points back to 2D
-    newX = ((newX * camera_focal_length_px) / Z) + image_centre_w;
-    newY = ((newY * camera_focal_length_px) / Z) + image_centre_h;
+    newX = ((newX * camera.focal_length) / Z) + camera.centre_w - origin[0];
+    newY = ((newY * camera.focal_length) / Z) + camera.centre_h - origin[1];
     results = (int(newX), int(newY))
     return results
 
@@ -421,8 +1005,8 @@ def getCenterPoint(points):
     return (int(x),int(y))
 
 # plotting of the planar normal direction direction glyph / vector in the image
-def drawNormalLine(baseImage, center, normal, disparity):
-    newLine = getNormalVectorLine(center, normal, disparity)
+def drawNormalLine(baseImage, center, normal, disparity, camera=default_camera, max_disparity=max_disparity, origin=(0,0)):
+    newLine = getNormalVectorLine(center, normal, disparity, camera, max_disparity, origin)
     lineThickness = 2
     normalLineColor = (204,185,22)
     cv2.line(baseImage, center, newLine, normalLineColor, lineThickness)
@@ -436,71 +1020,61 @@ def drawNormalLine(baseImage, center, normal, disparity):
 
 def printFilenamesAndNormals(filename_l, normal):
     normalString = "(0,0,0)"
-    nd = 1/math.sqrt(normal[0]*normal[0]+normal[1]*normal[1]+normal[2]*normal[2])
 
     if normal is not None:
-        normalString = "("+str(round(nd*normal[0][0],4))+", " + str(round(nd*normal[1][0],4))+", " + str(round(nd*normal[2][0],4))+")"
+        nx, ny, nz = np.ravel(normal) / np.linalg.norm(normal)
+        normalString = "("+str(round(nx,4))+", " + str(round(ny,4))+", " + str(round(nz,4))+")"
 
     filename_r = filename_l.replace("_L", "_R")
     print(filename_l);
     print(filename_r + " - Road Surface Normal:" + normalString)
 
-def getBlackImage():
-    # returns a black image (the size of our reference image)
-    return blackImg
+def getBlackImage(size=None):
+    # returns a black image (the size of our reference image by default)
+    return np.zeros_like(masks.get('black', size))
 
 def resizeImage(image, height, width):
     image = cv2.resize(image, (width, height))
     return image
 
-def batchImages(imgList, size):
-    # for each image, resize them.
-    counts = len(imgList)
-
-    # resize all images s.t they all fit accordingly.
-    images = []
-    for i in imgList:
-        fixedScaleImg = resizeImage(i[1], size[0], size[1])
-        # check if greyscale
-        dim = len(fixedScaleImg.shape)
-        if dim != 3:
-            # convert to colour.
-            fixedScaleImg = cv2.cvtColor(fixedScaleImg, cv2.COLOR_GRAY2BGR)
-        # add to list.
-        images.append(fixedScaleImg)
-        
+def tileLayout(counts, size):
+    # where each image goes in the tiled image: (index, y, x, height, width),
+    # and the size of the tiled image.
+    h, w = size
     if counts == 1:
-        return images[0]
+        return [(0, 0, 0, h, w)], (h, w)
     if counts == 2:
-        stack = np.hstack((images[0], images[1]))
-        return cv2.resize(stack, (0,0), fx=0.5, fy=0.5) 
-    if counts == 3:
-        p1 = np.hstack((images[0], images[1]))
-        p2 = np.hstack((images[2], images[2]))
-        stack = np.vstack((p1, p2))
-        return cv2.resize(stack, (0,0), fx=0.5, fy=0.5) 
-    if counts == 4:
-        p1 = np.hstack((images[0], images[1]))
-        p2 = np.hstack((images[2], images[3]))
-        stack = np.vstack((p1, p2))
-        return cv2.resize(stack, (0,0), fx=0.5, fy=0.5)
-    if counts == 4:
-        p1 = np.hstack((images[0], images[1]))
-        p2 = np.hstack((images[2], images[3]))
-        stack = np.vstack((p1, p2))
-        return cv2.resize(stack, (0,0), fx=0.5, fy=0.5)
+        return [(0, 0, 0, h // 2, w // 2), (1, 0, w // 2, h // 2, w // 2)], (h // 2, w)
+    if counts in (3, 4):
+        # with 3 images the last one fills both bottom tiles.
+        last = 3 if counts == 4 else 2
+        return [(0, 0, 0, h // 2, w // 2), (1, 0, w // 2, h // 2, w // 2),
+                (2, h // 2, 0, h // 2, w // 2), (last, h // 2, w // 2, h // 2, w // 2)], (h, w)
     if counts == 5:
-        p1 = np.hstack((images[0], images[1]))
-        p2 = np.hstack((images[2], images[3]))
-        stack = np.vstack((p1, p2))
-        l = cv2.resize(stack, (0,0), fx=0.25, fy=0.25)
-        r =  cv2.resize(images[4], (0,0), fx=0.5, fy=0.5)
-        r = np.hstack((l, r))
-        return r
-    else:
-        pass
+        # four quarter size tiles on the left, the last image at half size on the right.
+        q, p = h // 4, w // 4
+        return [(0, 0, 0, q, p), (1, 0, p, q, p), (2, q, 0, q, p), (3, q, p, q, p),
+                (4, 0, 2 * p, h // 2, w // 2)], (h // 2, 2 * p + w // 2)
+    return None, None
 
-def handleKey(cv2, pause_playback, disparity_scaled, imgL, imgR, crop_disparity):
+def batchImages(imgList, size):
+    # resize each image straight into its place in the tiled image.
+    layout, shape = tileLayout(len(imgList), size)
+    if layout is None:
+        return None
+    tiled = np.empty(shape + (3,), np.uint8)
+    for index, y, x, height, width in layout:
+        image = imgList[index][1]
+        tile = tiled[y:y + height, x:x + width]
+        # check if greyscale
+        if len(image.shape) != 3:
+            # convert to colour (after resizing, s.t it is done on fewer pixels).
+            cv2.cvtColor(cv2.resize(image, (width, height)), cv2.COLOR_GRAY2BGR, tile)
+        else:
+            cv2.resize(image, (width, height), tile)
+    return tiled
+
+def handleKey(cv2, pause_playback, disparity_scaled, imgL, imgR, crop_disparity, sink=None):
     # keyboard input for exit (as standard), save disparity and cropping
         # exit - x
         # save - s
@@ -509,9 +1083,13 @@ def handleKey(cv2, pause_playback, disparity_scaled, imgL, imgR, crop_disparity)
     # wait 40ms (i.e. 1000ms / 25 fps = 40 ms)
     key = cv2.waitKey(2 * (not(pause_playback))) & 0xFF;
     if (key == ord('s')):     # save
-        cv2.imwrite("sgbm-disparty.png", disparity_scaled);
-        cv2.imwrite("left.png", imgL);
-        cv2.imwrite("right.png", imgR);
+        images = {"sgbm-disparty.png": disparity_scaled, "left.png": imgL, "right.png": imgR}
+        if sink is not None:
+            # written by the output thread.
+            sink.snapshot(images)
+        else:
+            for filename, image in images.items():
+                cv2.imwrite(filename, image);
     elif (key == ord('c')):     # crop
         crop_disparity = not(crop_disparity);
     elif (key == ord(' ')):     # pause (on next frame)
@@ -0,0 +1,178 @@
+import collections
+import os
+import threading
+import cv2
+import numpy as np
+import functions as f
+import export
+
+# per frame artefacts that can be written, and the file each one goes to.
+artefact_files = {'road_mask': "%s_road.png",
+                  'disparity': "%s_disparity.png",
+                  'disparity_npy': "%s_disparity.npy",
+                  'cloud_ply': "%s_cloud.ply"}
+
+class OutputSink(threading.Thread):
+    """
+    Writes everything the pipeline outputs on its own thread, in order:
+    the printed normals, the video frames, snapshots, per frame artefacts
+    and the frames of an export.FrameStore. At most `size` items wait in
+    the queue. When it is full, the 'block' policy makes the caller wait,
+    and 'drop_oldest' drops the oldest waiting video frame or artefact
+    instead (normals, snapshots and stored frames are never dropped).
+    close() writes everything still queued.
+    """
+
+    def __init__(self, size=8, policy='block', video_filename=None, fps=8,
+                 artefacts=(), directory="output", store=None):
+        threading.Thread.__init__(self, daemon=True)
+        if policy not in ('block', 'drop_oldest'):
+            raise ValueError("unknown output policy: " + str(policy))
+        self.size = size
+        self.policy = policy
+        self.video_filename = video_filename
+        self.fps = fps
+        self.video_writer = None
+        self.artefacts = tuple(artefacts)
+        for artefact in self.artefacts:
+            if artefact not in artefact_files:
+                raise ValueError("unknown artefact: " + str(artefact))
+        self.directory = directory
+        self.store = store
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    # ---------------------------------------------------------------
+    # queueing (on the caller's thread)
+    # ---------------------------------------------------------------
+
+    def put(self, item, droppable=True):
+        with self.condition:
+            if self.policy == 'drop_oldest' and droppable:
+                while len(self.items) >= self.size and self.dropOldest():
+                    pass
+            while len(self.items) >= self.size:
+                self.condition.wait()
+            self.items.append((droppable, item))
+            self.condition.notify_all()
+
+    def dropOldest(self):
+        # drop the oldest item that may be dropped (False if there is none).
+        for i, (droppable, _) in enumerate(self.items):
+            if droppable:
+                del self.items[i]
+                self.dropped += 1
+                return True
+        return False
+
+    def normal(self, filename_l, normal):
+        self.put(('normal', filename_l, normal), droppable=False)
+
+    def video(self, image):
+        # image is a tiled image, or a StereoResult to tile on this thread.
+        if self.video_filename is not None:
+            self.put(('video', image))
+
+    def snapshot(self, images):
+        # images is {filename: image}. they are copied, as the caller may
+        # still be reusing the arrays.
+        self.put(('files', dict((name, np.array(image, copy=True)) for name, image in images.items())), droppable=False)
+
+    def result(self, filename_l, result):
+        # the configured artefacts of a frame's StereoResult.
+        if self.artefacts or self.store is not None:
+            # the store has to have every frame.
+            self.put(('result', filename_l, result), droppable=self.store is None)
+
+    def close(self):
+        # finish writing everything that has been queued.
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join()
+        if self.dropped > 0:
+            print("Output dropped", self.dropped, "items")
+
+    # ---------------------------------------------------------------
+    # writing (on the sink's thread)
+    # ---------------------------------------------------------------
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.items and not self.closed:
+                        self.condition.wait()
+                    if not self.items:
+                        break
+                    _, item = self.items.popleft()
+                    self.condition.notify_all()
+                try:
+                    self.write(item)
+                except Exception as e:
+                    print("There was an error writing the frame output:", e)
+        finally:
+            if self.store is not None:
+                self.store.close()
+            # save video to file.
+            if self.video_writer is not None:
+                self.video_writer.release()
+                print("Video saved to:", self.video_filename)
+
+    def write(self, item):
+        kind = item[0]
+        if kind == 'normal':
+            # print filenames and normals.
+            f.printFilenamesAndNormals(item[1], item[2])
+        elif kind == 'video':
+            image = item[1]
+            if hasattr(image, 'tiles'):
+                image = image.tiles()
+            if self.video_writer is None:
+                # the video is the size of the first frame.
+                fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+                height, width = image.shape[:2]
+                self.video_writer = cv2.VideoWriter(self.video_filename, fourcc, self.fps, (width, height))
+            self.video_writer.write(image)
+        elif kind == 'files':
+            self.writeFiles(item[1])
+        elif kind == 'result':
+            filename_l, result = item[1], item[2]
+            name = self.frameName(filename_l, result)
+            self.writeFiles(self.artefactFiles(name, result))
+            if 'cloud_ply' in self.artefacts:
+                os.makedirs(self.directory, exist_ok=True)
+                export.writePLY(os.path.join(self.directory, artefact_files['cloud_ply'] % name), result.cloud())
+            if self.store is not None:
+                self.store.append(name, result.cloud(), result.road_mask, result.stats["Frame"])
+
+    def frameName(self, filename_l, result):
+        return os.path.splitext(os.path.basename(filename_l or "frame_%06d" % result.stats["Frame"]))[0]
+
+    def artefactFiles(self, name, result):
+        # {filename: image} of the image artefacts of a frame.
+        images = {'road_mask': result.road_mask, 'disparity': result.disparity, 'disparity_npy': result.disparity}
+        return dict((os.path.join(self.directory, artefact_files[artefact] % name), images[artefact])
+                    for artefact in self.artefacts if artefact in images)
+
+    def writeFiles(self, images):
+        for filename, image in images.items():
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if filename.endswith(".npy"):
+                np.save(filename, image)
+            else:
+                cv2.imwrite(filename, image)
+
+def createOutputSink(opt):
+    # the sink for a run with the given options (already started).
+    store = export.FrameStore(opt['export_store']) if opt['export_store'] else None
+    sink = OutputSink(opt['output_queue_size'], opt['output_policy'],
+                      opt['video_filename'] if opt['record_video'] else None,
+                      artefacts=opt['artefacts'], directory=opt['artefact_directory'], store=store)
+    sink.start()
+    return sink
@@ -0,0 +1,148 @@
+import atexit
+import cProfile
+import csv
+import json
+import threading
+import time
+import tracemalloc
+
+# stages of performStereoVision that are timed, in the order they run.
+stages = ["Rectification", "Preprocessing", "SGBM", "Filling", "Projection", "RANSAC",
+          "Histogram", "Sanitise", "Obstacles", "Drawing", "Tiling"]
+
+# -------------------------------------------------------------------
+# STAGE TIMING
+# -------------------------------------------------------------------
+
+class StageClock(object):
+    """
+    Times the stages of a frame into its stats. Each call to lap() adds
+    the time since the previous lap to the given stage.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        # add every stage up front s.t the columns are the same on every frame.
+        for stage in stages:
+            stats["Time " + stage] = 0.0
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        key = "Time " + stage
+        self.stats[key] = round(self.stats[key] + now - self.last, 4)
+        self.last = now
+
+# -------------------------------------------------------------------
+# STATS WRITER
+# -------------------------------------------------------------------
+
+class StatsWriter(object):
+    """
+    Long lived writer for the per frame stats, as CSV or JSON lines.
+    The file is opened once and only flushed every `flush_every` frames.
+    A CSV file is rewritten with the wider header when a frame has stats
+    no earlier frame had (the earlier rows get "-" for them).
+    """
+
+    def __init__(self, filename="statistics.csv", format="csv", flush_every=50):
+        if format not in ("csv", "jsonl"):
+            raise ValueError("unknown stats format: " + str(format))
+        self.format = format
+        self.flush_every = flush_every
+        self.frames = 0
+        self.filename = filename
+        self.fp = open(filename, 'w', newline='')
+        self.writer = None
+        self.fieldnames = []
+        # pipelines on other threads may share the writer.
+        self.lock = threading.Lock()
+
+    def write(self, stats):
+        with self.lock:
+            self.writeRow(stats)
+
+    def writeRow(self, stats):
+        if self.format == "jsonl":
+            self.fp.write(json.dumps(stats, default=str) + "\n")
+        else:
+            added = [key for key in stats if key not in self.fieldnames]
+            if self.writer is None or added:
+                self.addColumns(added)
+            self.writer.writerow(stats)
+        self.frames += 1
+        if self.frames % self.flush_every == 0:
+            self.fp.flush()
+
+    def addColumns(self, added):
+        # the timed stages always have a column, whichever frame they first run on.
+        if self.writer is None:
+            added = added + ["Time " + stage for stage in stages if "Time " + stage not in added]
+        rows = []
+        if self.writer is not None:
+            # read back the rows written so far.
+            self.fp.flush()
+            with open(self.filename, newline='') as fp:
+                rows = list(csv.DictReader(fp))
+            self.fp.seek(0)
+            self.fp.truncate()
+        self.fieldnames = self.fieldnames + added
+        self.writer = csv.DictWriter(self.fp, fieldnames=self.fieldnames, restval="-")
+        self.writer.writeheader()
+        self.writer.writerows(rows)
+
+    # the writer can be used directly as a stats hook.
+    __call__ = write
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+default_writers = {}
+default_writers_lock = threading.Lock()
+
+def getStatsWriter(filename="statistics.csv", format="csv"):
+    # one writer per file for the whole process, closed when we exit.
+    key = (filename, format)
+    with default_writers_lock:
+        if key not in default_writers:
+            default_writers[key] = StatsWriter(filename, format)
+            atexit.register(default_writers[key].close)
+        return default_writers[key]
+
+# -------------------------------------------------------------------
+# PROFILING
+# -------------------------------------------------------------------
+
+class FrameProfiler(object):
+    """
+    Captures a cProfile and a tracemalloc snapshot over frames first to
+    last (inclusive). The results are written to <filename>.prof and
+    <filename>_memory.txt once the last frame has been processed.
+    """
+
+    def __init__(self, first, last, filename="profile", top=25):
+        self.first = first
+        self.last = last
+        self.filename = filename
+        self.top = top
+        self.profile = None
+
+    def begin(self, frame):
+        if frame == self.first and self.profile is None:
+            tracemalloc.start()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def end(self, frame):
+        if frame == self.last and self.profile is not None:
+            self.profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.profile.dump_stats(self.filename + ".prof")
+            with open(self.filename + "_memory.txt", 'w') as fp:
+                fp.write("frames %d-%d: current %d bytes, peak %d bytes\n" % (self.first, self.last, current, peak))
+                for stat in snapshot.statistics('lineno')[:self.top]:
+                    fp.write(str(stat) + "\n")
+            self.profile = None
@@ -0,0 +1,117 @@
+import time
+
+# the knobs the controller may turn, the stages each one makes cheaper and
+# its value at every step down in quality (step 0 is the configured value).
+quality_knobs = [
+    ('headless', ("Drawing", "Tiling"), [True]),
+    ('ransac_trials', ("RANSAC",), [0.5, 0.25, 0.1]),
+    ('projection_stride', ("Projection", "Histogram", "Sanitise"), [3, 4, 6]),
+    ('disparity_scale', ("Preprocessing", "SGBM", "Filling"), [0.5, 0.25]),
+]
+
+def knobValue(knob, configured, value):
+    # never let a step be better than what was configured.
+    if knob == 'headless':
+        return configured or value
+    if knob == 'ransac_trials':
+        return max(1, int(configured * value))
+    if knob == 'projection_stride':
+        return max(configured, value)
+    if knob == 'disparity_scale':
+        return min(configured, value)
+    return value
+
+class QualityController(object):
+    """
+    Keeps the frames within a latency deadline. The smoothed time of every
+    stage is watched, and when a frame is over `high` of the deadline the
+    knob of the most expensive stage that can still be turned is stepped
+    down. When the frames have stayed under `low` of the deadline for
+    `patience` frames the last step taken is undone. Frames that are
+    already more than `drop_after` deadlines old when they arrive are
+    dropped. Every decision is recorded in the stats of the next frame.
+    """
+
+    def __init__(self, deadline, high=0.9, low=0.6, patience=10, smoothing=0.3, drop_after=2.0, knobs=quality_knobs):
+        self.deadline = deadline
+        self.high = high
+        self.low = low
+        self.patience = patience
+        self.smoothing = smoothing
+        self.drop_after = drop_after
+        self.knobs = knobs
+        self.steps = dict((knob, 0) for knob, _, _ in knobs)
+        # the knobs stepped down, in order (undone from the end).
+        self.history = []
+        self.timings = {}
+        self.calm = 0
+        self.dropped = 0
+        self.decision = "hold"
+
+    def level(self):
+        return len(self.history)
+
+    def drop(self, captured):
+        # True if the frame is too old to be worth processing.
+        if self.deadline is None or time.perf_counter() - captured <= self.deadline * self.drop_after:
+            return False
+        self.dropped += 1
+        return True
+
+    def options(self, opt, stats):
+        # the options for the next frame, with its quality recorded in stats.
+        frame_opt = dict(opt)
+        for knob, _, values in self.knobs:
+            step = self.steps[knob]
+            if step > 0:
+                frame_opt[knob] = knobValue(knob, opt[knob], values[step - 1])
+        stats["Deadline"] = self.deadline
+        stats["Quality Level"] = self.level()
+        stats["Quality Decision"] = self.decision
+        stats["Frames Dropped"] = self.dropped
+        self.decision = "hold"
+        self.dropped = 0
+        return frame_opt
+
+    def update(self, stats):
+        # decide the quality of the next frame from the timings of this one.
+        a = self.smoothing
+        for key, value in stats.items():
+            if key.startswith("Time ") and isinstance(value, (int, float)):
+                self.timings[key] = value if key not in self.timings else (1 - a) * self.timings[key] + a * value
+        taken = self.timings.get("Time Taken", 0.0)
+        if taken > self.deadline * self.high:
+            self.calm = 0
+            knob = self.mostExpensiveKnob()
+            if knob is not None:
+                self.steps[knob] += 1
+                self.history.append(knob)
+                self.decision = "degrade " + knob
+                # start again from this frame's timings at the new quality.
+                self.timings = {}
+        elif taken < self.deadline * self.low and self.history:
+            self.calm += 1
+            if self.calm >= self.patience:
+                self.calm = 0
+                knob = self.history.pop()
+                self.steps[knob] -= 1
+                self.decision = "restore " + knob
+                self.timings = {}
+        else:
+            self.calm = 0
+
+    def mostExpensiveKnob(self):
+        best, bestTime = None, -1.0
+        for knob, knobStages, values in self.knobs:
+            if self.steps[knob] >= len(values):
+                continue
+            cost = sum(self.timings.get("Time " + stage, 0.0) for stage in knobStages)
+            if cost > bestTime:
+                best, bestTime = knob, cost
+        return best
+
+def createQualityController(opt):
+    # adaptive quality for a sequence (None if there is no deadline).
+    if opt['deadline'] is None:
+        return None
+    return QualityController(opt['deadline'], drop_after=opt['deadline_drop'])
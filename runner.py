@@ -0,0 +1,190 @@
+import time
+import math
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import functions as f
+import stereovision as sv
+import sources
+import quality
+import output as out
+
+# -------------------------------------------------------------------
+# PIPELINED LOOP
+# -------------------------------------------------------------------
+
+def runPipelined(source, options):
+    """
+    Runs the stereo vision over a frame source (see sources.py) with image
+    decoding, processing and output overlapped. Returns the sustained frames
+    per second.
+    """
+    # normals, video, snapshots and artefacts are written on their own thread.
+    sink = out.createOutputSink(options)
+
+    # previous disparity, plane state and buffers (for the next frame)
+    pipeline = sv.StereoPipeline(dict(options, output_sink=sink))
+    # scales the quality to keep within the deadline (if one is set).
+    controller = quality.createQualityController(options)
+    frames = 0
+    # time from each frame becoming available to its result.
+    latencies = []
+    start_time = time.time()
+    stream = iter(source)
+    try:
+        for filename_l, images, captured in stream:
+            if images is None:
+                print("-- files skipped (perhaps one is missing or not PNG)")
+                continue
+            imgL, imgR = images
+            stats = {}
+            frame_options = None
+            if controller is not None:
+                # don't let a backlog build up behind a slow frame.
+                if controller.drop(captured):
+                    continue
+                frame_options = controller.options(pipeline.options, stats)
+            # compute stereo vision (in order, as each frame needs the last disparity)
+            image, normal = pipeline.process(imgL, imgR, filename_l, stats, frame_options)
+            if controller is not None:
+                controller.update(stats)
+            latencies.append(time.perf_counter() - captured)
+            sink.normal(filename_l, normal)
+            sink.video(image)
+            frames += 1
+    finally:
+        # any iterable of frames is a source, only generators need closing.
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+        sink.close()
+
+    elapsed = time.time() - start_time
+    fps = frames / elapsed if elapsed > 0 else 0.0
+    print("Processed", frames, "frames at", round(fps, 2), "fps")
+    if latencies:
+        print("Latency p50", round(np.percentile(latencies, 50), 4), "s, p95", round(np.percentile(latencies, 95), 4), "s")
+    return fps
+
+# -------------------------------------------------------------------
+# CONCURRENT STREAMS
+# -------------------------------------------------------------------
+
+def runStream(index, source, pipeline, callback):
+    # process one stream in order, returning the number of frames processed.
+    frames = 0
+    stream = iter(source)
+    try:
+        for filename_l, images, _ in stream:
+            if images is None:
+                continue
+            imgL, imgR = images
+            stats = {}
+            image, normal = pipeline.process(imgL, imgR, filename_l, stats)
+            callback(index, filename_l, image, normal, stats)
+            frames += 1
+    finally:
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+    return frames
+
+def printStreamNormal(index, filename_l, image, normal, stats):
+    print("stream", index, "-", filename_l, "- Road Surface Normal:", None if normal is None else tuple(np.round(np.ravel(normal), 4)))
+
+def runStreams(streams, options, callback=printStreamNormal, threads=None):
+    """
+    Runs several independent streams (e.g. one per camera rig) at once,
+    each through its own StereoPipeline on a thread pool. streams is a
+    list of frame sources, or of (source, options) to configure each rig.
+    callback(index, filename, result, normal, stats) is called on the
+    stream's thread after each frame. Returns the frames processed per stream.
+    """
+    pipelines = []
+    stream_sources = []
+    for stream in streams:
+        source, stream_options = stream if isinstance(stream, tuple) else (stream, options)
+        # streams never display, windows can only be driven from one thread.
+        pipelines.append(sv.StereoPipeline(dict(stream_options, loop=False, output_sink=None)))
+        stream_sources.append(source)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=threads or len(pipelines)) as executor:
+        futures = [executor.submit(runStream, i, source, pipeline, callback)
+                   for i, (source, pipeline) in enumerate(zip(stream_sources, pipelines))]
+        frames = [future.result() for future in futures]
+    elapsed = time.time() - start_time
+    fps = sum(frames) / elapsed if elapsed > 0 else 0.0
+    print("Processed", sum(frames), "frames from", len(frames), "streams at", round(fps, 2), "fps")
+    return frames
+
+# -------------------------------------------------------------------
+# MULTI-PROCESS BATCH
+# -------------------------------------------------------------------
+
+def processChunk(chunk):
+    """
+    Processes a contiguous chunk of a sequence in a worker process. The
+    warm up pairs are processed first only to build the previous disparity
+    and plane. first is the frame number of the first pair in the whole
+    sequence, s.t every frame is numbered (and seeded) as in a serial run.
+    Returns a list of (filename, normal, stats, image) in order.
+    """
+    first, warmup, pairs, options, keep_frames = chunk
+    # workers never display, profile or write statistics themselves.
+    options = dict(options, loop=False, record_stats=False, stats_hook=None, profiler=None, deadline=None, output_sink=None)
+    pipeline = sv.StereoPipeline(options)
+    pipeline.frame = first - 1 - len(warmup)
+    # each worker writes the artefacts of its own frames.
+    sink = None
+    if options['artefacts']:
+        sink = out.OutputSink(options['output_queue_size'], artefacts=options['artefacts'],
+                              directory=options['artefact_directory'])
+        sink.start()
+    frame_options = dict(options, output_sink=sink)
+    for filename_l, imgPaths in warmup:
+        imgL, imgR = f.loadImages(imgPaths)
+        pipeline.process(imgL, imgR, filename_l)
+    results = []
+    for filename_l, imgPaths in pairs:
+        imgL, imgR = f.loadImages(imgPaths)
+        stats = {}
+        image, normal = pipeline.process(imgL, imgR, filename_l, stats, frame_options)
+        results.append((filename_l, normal, stats, image if keep_frames else None))
+    if sink is not None:
+        sink.close()
+    return results
+
+def splitChunks(pairs, chunks, overlap):
+    # split the pairs into contiguous chunks, each with the `overlap` pairs
+    # before it to warm up the disparity filling on. yields the frame
+    # number of the first pair (from 1), the warm up pairs and the chunk.
+    size = int(math.ceil(len(pairs) / float(max(chunks, 1))))
+    for start in range(0, len(pairs), max(size, 1)):
+        yield start + 1, pairs[max(0, start - overlap):start], pairs[start:start + size]
+
+def runBatch(filelist_l, path_dir_l, path_dir_r, options, processes=None, overlap=3,
+             keep_frames=False, skip_forward_file_pattern=""):
+    """
+    Processes a whole sequence offline, sharded across a process pool.
+    Returns the per frame (filename, normal, stats, image) in timestamp order.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    pairs = []
+    for filename_l, imgPaths in sources.getStereoPairs(filelist_l, path_dir_l, path_dir_r, skip_forward_file_pattern):
+        if imgPaths == False:
+            print("-- files skipped (perhaps one is missing or not PNG)")
+            continue
+        pairs.append((filename_l, imgPaths))
+
+    start_time = time.time()
+    chunks = [(first, warmup, chunk, options, keep_frames) for first, warmup, chunk in splitChunks(pairs, processes, overlap)]
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # map keeps the chunks (and so the frames) in timestamp order.
+        for chunk_results in executor.map(processChunk, chunks):
+            results.extend(chunk_results)
+
+    elapsed = time.time() - start_time
+    fps = len(results) / elapsed if elapsed > 0 else 0.0
+    print("Processed", len(results), "frames on", processes, "processes at", round(fps, 2), "fps")
+    return results
@@ -14,17 +14,52 @@ filename_l = "1506942475.481834_L.png"
 
 options = {
     'crop_disparity' : False,       # display full or cropped disparity image
+    'calibration' : None,           # calibration file of a raw (unrectified) rig, None for rectified images
+    'rectification_cache' : 'rectification', # directory the rectification maps of each calibration are kept in
     'pause_playback' : False,       # pause until key press after each image
     'max_disparity' : 128,
-    'ransac_trials' : 600,
+    'stereo_matcher' : 'sgbm',      # options are: 'sgbm' or 'bm' (faster, lower quality)
+    'block_size' : 21,              # matcher block size (odd)
+    'sgbm_p1' : 0,                  # SGBM smoothness penalties (0 for the opencv defaults)
+    'sgbm_p2' : 0,
+    'sgbm_mode' : 'sgbm',           # options are: 'sgbm', 'hh', 'hh4' or '3way' (fastest)
+    'disparity_roi' : False,        # only compute the disparity inside the bounding box of the masks
+    'cap_disparity' : False,        # zero the disparity outside the disparity cap mask (always on with disparity_roi)
+    'disparity_scale' : 1.0,        # run the matcher at this resolution (e.g. 0.5 or 0.25) and upsample
+    'ransac_trials' : 600,          # upper bound on the number of RANSAC trials
+    'ransac_confidence' : 0.99,     # stop RANSAC early once this confident of an all inlier sample
+    'random_seed' : None,           # seed the RANSAC of every frame from this and its frame number (None for unseeded)
+    'plane_tracking' : True,        # seed RANSAC with (and smooth) the plane of the previous frames
+    'tracking_refine_fraction' : 0.1, # fraction of ransac_trials used while the plane is tracked
+    'tracking_points' : 3000,       # points the tracked plane is refitted on
+    'tracking_smoothing' : 0.5,     # weight of the new plane in the smoothed plane
     'road_color_thresh': 10,        # remove points from roadpts if it isn't in the x most populous colours 
-    'point_threshold' : 0.05,
+    'hue_bins' : 1000,              # resolution of the road colour histogram
+    'point_threshold' : 0.1,        # furthest a point can be from the plane to be on the road (metres)
+    'projection_stride' : 2,        # sample every nth pixel when projecting the disparity to 3D
+    'road_segmentation' : 'pixel',  # options are: 'pixel' (use projected pixels) or 'projection' (project points back to 2D)
+    'obstacle_min_area' : 20,       # smallest obstacle reported (pixels)
     'image_tiles' : True,           # show all images involved in the process or not
+    'headless' : False,             # only compute structured results, images are drawn on request
     'img_size' : (544,1024),
-    'threshold_option' : 'previous', # options are: 'previous' or 'mean'
+    'threshold_option' : 'previous', # options are: 'previous', 'mean' or 'warp' (previous, moved with the car)
+    'ego_motion_max' : 2.0,         # furthest the car is searched to have moved per frame (metres) for 'warp'
+    'deadline' : None,              # per frame latency budget in seconds, the quality is scaled to meet it (None to disable)
+    'deadline_drop' : 2.0,          # drop frames that are already this many deadlines old when they arrive
+    'disparity_cache' : None,       # directory to cache the disparities in (None to disable)
     'loop': False,
     'record_video' : False,
     'record_stats' : False,
+    'stats_filename' : 'statistics.csv',
+    'stats_format' : 'csv',         # options are: 'csv' or 'jsonl'
+    'stats_hook' : None,            # called with the stats of every frame
+    'profiler' : None,              # e.g. profiling.FrameProfiler(10, 20) to profile frames 10-20
+    'output_queue_size' : 8,        # items waiting to be written before the output policy applies
+    'output_policy' : 'block',      # when the output queue is full: 'block' or 'drop_oldest' (video frames and artefacts)
+    'artefacts' : (),               # per frame files to write: 'road_mask', 'disparity' (PNG), 'disparity_npy' and/or 'cloud_ply'
+    'artefact_directory' : 'output',
+    'export_store' : None,          # directory of the store the clouds and road masks of every frame are appended to
+    'output_sink' : None,           # output.OutputSink that snapshots and artefacts are written through
     'video_filename' : 'previous.avi'
 }
 
@@ -34,23 +69,23 @@ options = {
 
 import cv2
 import os
-import numpy as np
 import functions as f
 import stereovision as sv
+import sources
 
 # resolve full directory location of data set for left / right images
 path_dir_l =  os.path.join(dataset_path, directory_to_cycle_left)
 path_dir_r =  os.path.join(dataset_path, directory_to_cycle_right)
-# get a list of the left image files and sort them (by timestamp in filename)
-filelist_l = sorted(os.listdir(path_dir_l))
-
-# load images
-imgPaths = f.getImagePaths(filename_l, path_dir_l, path_dir_r)
-if imgPaths != False:
-    # load image files
-    imgL, imgR = f.loadImages(imgPaths)
+
+# load images (the first frame of the source from filename_l on)
+source = sources.DirectorySource(path_dir_l, path_dir_r, filename_l, prefetch=0, threads=1)
+frames = iter(source)
+frame = next(frames, None)
+frames.close()
+if frame is not None and frame[1] is not None:
+    filename_l, (imgL, imgR), _ = frame
     # perform stereo vision
-    imgL, _, normal = sv.performStereoVision(imgL, imgR, None, options)
+    imgL, normal = sv.StereoPipeline(options).process(imgL, imgR, filename_l)
     # display results.
     cv2.imshow('Single Frame Image Result',imgL)
     # display text 
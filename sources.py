@@ -0,0 +1,264 @@
+import collections
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import functions as f
+
+# Every frame source is an iterable of (filename, images, captured) where
+# images is (imgL, imgR), or None if the pair had to be skipped, and
+# captured is the time.perf_counter() at which the frame became available.
+# Live sources (a watched directory or a camera) stamp when the frame
+# arrived, so the quality controller can drop frames that are already too
+# old. Recorded input (an image directory or a video) stamps when the
+# frame is read, so it is never dropped.
+
+# -------------------------------------------------------------------
+# IMAGE DIRECTORIES
+# -------------------------------------------------------------------
+
+def getStereoPairs(filelist_l, path_dir_l, path_dir_r, skip_forward_file_pattern=""):
+    # yields (filename, image paths) for each left image, in order.
+    # the image paths are False if the pair cannot be loaded.
+    for filename_l in filelist_l:
+        # skip forward to start a file we specify by timestamp (if this is set)
+        if ((len(skip_forward_file_pattern) > 0) and not(skip_forward_file_pattern in filename_l)):
+            continue
+        skip_forward_file_pattern = ""
+        yield filename_l, f.getImagePaths(filename_l, path_dir_l, path_dir_r)
+
+def prefetchImages(pairs, executor, depth):
+    # decode the next `depth` stereo pairs on the executor while the
+    # current one is being processed. frames are yielded in their original
+    # order as (filename, (imgL, imgR), captured), or (filename, None, captured) if skipped.
+    pending = collections.deque()
+    for filename_l, imgPaths in pairs:
+        future = None
+        if imgPaths != False:
+            future = executor.submit(f.loadImages, imgPaths)
+        pending.append((filename_l, future))
+        if len(pending) > depth:
+            yield resolveFrame(pending.popleft())
+    while pending:
+        yield resolveFrame(pending.popleft())
+
+def resolveFrame(pending):
+    filename_l, future = pending
+    if future is None:
+        return filename_l, None, time.perf_counter()
+    images = future.result()
+    return filename_l, images, time.perf_counter()
+
+class DirectorySource(object):
+    """
+    Stereo pairs from a left and a right image directory, decoded ahead on
+    a thread pool. In watch mode the directory is polled for new images
+    once the existing ones are used up, until none arrive for idle_timeout
+    seconds (None to wait forever). Watched frames are stamped with the
+    time their left image was written, and only read once both images
+    are complete.
+    """
+
+    def __init__(self, path_dir_l, path_dir_r, skip_forward_file_pattern="", prefetch=4,
+                 threads=2, watch=False, poll_interval=0.5, idle_timeout=None):
+        self.path_dir_l = path_dir_l
+        self.path_dir_r = path_dir_r
+        self.skip_forward_file_pattern = skip_forward_file_pattern
+        self.prefetch = prefetch
+        self.threads = threads
+        self.watch = watch
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+
+    def filenames(self):
+        # the left images in timestamp order.
+        return sorted(os.listdir(self.path_dir_l))
+
+    def watchedFrames(self):
+        # poll for new pairs as they appear. a pair is only yielded once both
+        # images can be read (the right image may still be on its way, or a
+        # PNG still being written). one that never completes is skipped as
+        # soon as a newer pair is complete, s.t it cannot hold back the rest.
+        seen = set()
+        skip_forward_file_pattern = self.skip_forward_file_pattern
+        idle_since = time.time()
+        while True:
+            filelist_l = sorted(name for name in os.listdir(self.path_dir_l) if name not in seen)
+            imgPaths = [f.getImagePaths(name, self.path_dir_l, self.path_dir_r) for name in filelist_l]
+            for i, filename_l in enumerate(filelist_l):
+                if skip_forward_file_pattern and skip_forward_file_pattern not in filename_l:
+                    seen.add(filename_l)
+                    continue
+                skip_forward_file_pattern = ""
+                images = None
+                if imgPaths[i] != False:
+                    images = f.loadImages(imgPaths[i])
+                    if images[0] is None or images[1] is None:
+                        images = None
+                if images is None and '.png' in filename_l and not any(imgPaths[i + 1:]):
+                    # look again next time.
+                    break
+                seen.add(filename_l)
+                idle_since = time.time()
+                yield filename_l, images, self.arrival(filename_l, time.perf_counter())
+            if self.idle_timeout is not None and time.time() - idle_since > self.idle_timeout:
+                return
+            time.sleep(self.poll_interval)
+
+    def arrival(self, filename_l, read):
+        # the perf_counter() time the left image was written (if not after it was read).
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(self.path_dir_l, filename_l))
+        except OSError:
+            return read
+        return min(read, time.perf_counter() - max(age, 0.0))
+
+    def __iter__(self):
+        if self.watch:
+            # frames are read as they arrive, there is nothing to decode ahead.
+            yield from self.watchedFrames()
+            return
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            pairs = getStereoPairs(self.filenames(), self.path_dir_l, self.path_dir_r, self.skip_forward_file_pattern)
+            yield from prefetchImages(pairs, executor, self.prefetch)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+# -------------------------------------------------------------------
+# VIDEO FILES
+# -------------------------------------------------------------------
+
+class VideoSource(object):
+    """
+    Stereo pairs from a side by side video (left half and right half), or
+    from a left and a right video of the same length.
+    """
+
+    def __init__(self, filename_l, filename_r=None):
+        self.filename_l = filename_l
+        self.filename_r = filename_r
+
+    def __iter__(self):
+        name = os.path.splitext(os.path.basename(self.filename_l))[0]
+        capture_l = cv2.VideoCapture(self.filename_l)
+        capture_r = cv2.VideoCapture(self.filename_r) if self.filename_r else None
+        if not capture_l.isOpened() or (capture_r is not None and not capture_r.isOpened()):
+            raise IOError("cannot open video: " + str(self.filename_l))
+        index = 0
+        try:
+            while True:
+                ok, imgL = capture_l.read()
+                if not ok:
+                    return
+                if capture_r is None:
+                    # split the side by side frame down the middle.
+                    half = imgL.shape[1] // 2
+                    imgL, imgR = imgL[:, :half], imgL[:, half:2 * half]
+                else:
+                    ok, imgR = capture_r.read()
+                    if not ok:
+                        return
+                yield "%s_%06d" % (name, index), (imgL, imgR), time.perf_counter()
+                index += 1
+        finally:
+            capture_l.release()
+            if capture_r is not None:
+                capture_r.release()
+
+# -------------------------------------------------------------------
+# SIMULATED CAMERA
+# -------------------------------------------------------------------
+
+class CameraSource(object):
+    """
+    Simulates a camera by emitting the frames of another source at a fixed
+    rate on its own thread. Like a real camera it doesn't wait for the
+    consumer: when `buffer` frames are waiting the oldest one is dropped.
+    """
+
+    def __init__(self, source, fps=8, buffer=1, loop=False):
+        self.source = source
+        self.fps = fps
+        self.buffer = buffer
+        self.loop = loop
+        self.dropped = 0
+
+    def emit(self, frames, stop):
+        interval = 1.0 / self.fps
+        next_frame = time.perf_counter()
+        try:
+            while not stop.is_set():
+                for filename_l, images, _ in self.source:
+                    # wait for the next tick of the frame clock.
+                    next_frame += interval
+                    delay = next_frame - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    if stop.is_set():
+                        return
+                    while True:
+                        try:
+                            frames.put_nowait((filename_l, images, time.perf_counter()))
+                            break
+                        except queue.Full:
+                            try:
+                                frames.get_nowait()
+                                self.dropped += 1
+                            except queue.Empty:
+                                pass
+                if not self.loop:
+                    break
+        except Exception as e:
+            print("There was an error reading the camera frames:", e)
+        finally:
+            frames.put(None)
+
+    def __iter__(self):
+        # at most `buffer` frames wait (the end marker waits for a free slot).
+        frames = queue.Queue(maxsize=self.buffer)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.emit, args=(frames, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            stop.set()
+            # unblock the camera if it is waiting to put the end marker.
+            while thread.is_alive():
+                try:
+                    frames.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if self.dropped > 0:
+                print("Camera dropped", self.dropped, "frames")
+
+# -------------------------------------------------------------------
+# SOURCE SELECTION
+# -------------------------------------------------------------------
+
+def openSource(kind, path_dir_l=None, path_dir_r=None, skip_forward_file_pattern="", options=None,
+               video_l=None, video_r=None, fps=8):
+    """
+    Returns the frame source for kind: 'images' (the image directories),
+    'watch' (the image directories, waiting for new images), 'video' or
+    'camera' (the image directories replayed at fps).
+    """
+    options = options or {}
+    prefetch = options.get('prefetch_frames', 4)
+    threads = options.get('loader_threads', 2)
+    if kind == 'images':
+        return DirectorySource(path_dir_l, path_dir_r, skip_forward_file_pattern, prefetch, threads)
+    if kind == 'watch':
+        return DirectorySource(path_dir_l, path_dir_r, skip_forward_file_pattern, prefetch, threads, watch=True)
+    if kind == 'video':
+        return VideoSource(video_l, video_r)
+    if kind == 'camera':
+        return CameraSource(DirectorySource(path_dir_l, path_dir_r, skip_forward_file_pattern, prefetch, threads), fps)
+    raise ValueError("unknown frame source: " + str(kind))
@@ -3,77 +3,282 @@ import numpy as np
 import functions as f
 import time
 import sys
+import threading
 import traceback
-import csv
+import profiling as prof
+import export
+import calibration as cal
 
 # default values for stereo vision operations
 default_opts = {
     'crop_disparity' : False,       # display full or cropped disparity image
+    'calibration' : None,           # calibration file of a raw (unrectified) rig, None for rectified images
+    'rectification_cache' : 'rectification', # directory the rectification maps of each calibration are kept in
     'pause_playback' : False,       # pause until key press after each image
     'max_disparity' : 128,
-    'ransac_trials' : 600,
+    'stereo_matcher' : 'sgbm',      # options are: 'sgbm' or 'bm' (faster, lower quality)
+    'block_size' : 21,              # matcher block size (odd)
+    'sgbm_p1' : 0,                  # SGBM smoothness penalties (0 for the opencv defaults)
+    'sgbm_p2' : 0,
+    'sgbm_mode' : 'sgbm',           # options are: 'sgbm', 'hh', 'hh4' or '3way' (fastest)
+    'disparity_roi' : False,        # only compute the disparity inside the bounding box of the masks
+    'cap_disparity' : False,        # zero the disparity outside the disparity cap mask (always on with disparity_roi)
+    'disparity_scale' : 1.0,        # run the matcher at this resolution (e.g. 0.5 or 0.25) and upsample
+    'ransac_trials' : 600,          # upper bound on the number of RANSAC trials
+    'ransac_confidence' : 0.99,     # stop RANSAC early once this confident of an all inlier sample
+    'random_seed' : None,           # seed the RANSAC of every frame from this and its frame number (None for unseeded)
+    'plane_tracking' : True,        # seed RANSAC with (and smooth) the plane of the previous frames
+    'tracking_refine_fraction' : 0.1, # fraction of ransac_trials used while the plane is tracked
+    'tracking_points' : 3000,       # points the tracked plane is refitted on
+    'tracking_smoothing' : 0.5,     # weight of the new plane in the smoothed plane
     'road_color_thresh': 10,        # remove points from roadpts if it isn't in the x most populous colours 
+    'hue_bins' : 1000,              # resolution of the road colour histogram
     'loop': True,
-    'point_threshold' : 0.05,
+    'point_threshold' : 0.1,        # furthest a point can be from the plane to be on the road (metres)
+    'projection_stride' : 2,        # sample every nth pixel when projecting the disparity to 3D
+    'road_segmentation' : 'pixel',  # options are: 'pixel' (use projected pixels) or 'projection' (project points back to 2D)
+    'obstacle_min_area' : 20,       # smallest obstacle reported (pixels)
     'image_tiles' : True,           # show all images involved in the process or not
+    'headless' : False,             # only compute structured results, images are drawn on request
     'img_size' : (544,1024),
-    'threshold_option' : 'previous', # options are: 'previous' or 'mean'
+    'threshold_option' : 'previous', # options are: 'previous', 'mean' or 'warp' (previous, moved with the car)
+    'ego_motion_max' : 2.0,         # furthest the car is searched to have moved per frame (metres) for 'warp'
+    'deadline' : None,              # per frame latency budget in seconds, the quality is scaled to meet it (None to disable)
+    'deadline_drop' : 2.0,          # drop frames that are already this many deadlines old when they arrive
+    'disparity_cache' : None,       # directory to cache the disparities in (None to disable)
     'record_video' : False,
     'record_stats' : False,
+    'stats_filename' : 'statistics.csv',
+    'stats_format' : 'csv',         # options are: 'csv' or 'jsonl'
+    'stats_hook' : None,            # called with the stats of every frame
+    'profiler' : None,              # e.g. profiling.FrameProfiler(10, 20) to profile frames 10-20
+    'output_queue_size' : 8,        # items waiting to be written before the output policy applies
+    'output_policy' : 'block',      # when the output queue is full: 'block' or 'drop_oldest' (video frames and artefacts)
+    'artefacts' : (),               # per frame files to write: 'road_mask', 'disparity' (PNG), 'disparity_npy' and/or 'cloud_ply'
+    'artefact_directory' : 'output',
+    'export_store' : None,          # directory of the store the clouds and road masks of every frame are appended to
+    'output_sink' : None,           # output.OutputSink that snapshots and artefacts are written through
     'video_filename' : 'previous.avi'
 }
 
-def performStereoVision(imgL,imgR, prev_disp=None, opt=default_opts):
-    if 'frame' not in opt:
-        opt['frame'] = 1
-    else:
-        opt['frame'] += 1
-    # initiate stats list.
-    stats = {}
-    stats["Frame"] = opt['frame']
-    # initiate images list.
-    images = []
+class StereoResult(object):
+    """
+    Structured output of performStereoVision. The visual images are only
+    drawn the first time they are asked for.
+    """
+
+    def __init__(self, image, disparity, normal, road_image, road_mask, hull, center, obstacle_mask, obstacles, stats, img_size,
+                 points=None, inliers=None, camera=f.default_camera, max_disparity=f.max_disparity, origin=(0,0)):
+        self.image = image
+        self.disparity = disparity
+        self.normal = normal
+        self.road_image = road_image
+        self.road_mask = road_mask
+        self.hull = hull
+        self.center = center
+        self.obstacle_mask = obstacle_mask
+        self.obstacles = obstacles
+        self.stats = stats
+        self.img_size = img_size
+        # the point cloud of the capped disparity, and which points are on the plane.
+        self.points = points
+        self.inliers = inliers
+        # what the 8-bit disparity is projected with.
+        self.camera = camera
+        self.max_disparity = max_disparity
+        # where pixel (0,0) of the (possibly cropped) disparity and masks is in the image.
+        self.origin = origin
+        self._overlay = None
+        self._tiles = None
+
+    def disparityRegion(self, image):
+        # the view of the image that the disparity (and the masks) cover.
+        x, y = self.origin
+        height, width = self.disparity.shape[:2]
+        return image[y:y + height, x:x + width]
+
+    def roadMap(self):
+        # colour the road points green on a copy of the image.
+        imageRoadMap = self.image.copy()
+        self.disparityRegion(imageRoadMap)[self.road_image > 0] = [0,255,0]
+        return imageRoadMap
+
+    def overlay(self):
+        # the image with the obstacles, road hull and normal drawn on it.
+        if self._overlay is not None:
+            return self._overlay
+        resulting_image = self.image.copy()
+        # everything is drawn in disparity coordinates, onto its part of the image.
+        region = self.disparityRegion(resulting_image)
+        try:
+            # we overlay the obstacles on the image so that we can see where they are.
+            f.drawObstacles(region, self.obstacle_mask)
+            f.drawObstacleBoxes(region, self.obstacles)
+        except Exception as e:
+            print("There was an error in drawing obstacles:", e)
+        try:
+            # draw the convex hull on the image.
+            f.drawRoadLine(region, self.hull)
+            # draw normal line.
+            f.drawNormalLine(region, self.center, self.normal, self.disparity, self.camera, self.max_disparity, self.origin)
+        except Exception as e:
+            print("There was an error with drawing the hull:", e)
+        self._overlay = resulting_image
+        return resulting_image
+
+    def cloud(self):
+        # the point cloud as it is exported (see export.py).
+        return export.packCloud(self.points, self.inliers)
+
+    def tiles(self):
+        # all the images involved in the process, tiled into one image.
+        if self._tiles is None:
+            images = [("Disparity",self.disparity),
+                      ("Image Road Map",self.roadMap()),
+                      ("Road Image",self.road_image),
+                      ("Filtered Road Image",self.road_mask),
+                      ("Result",self.overlay())]
+            self._tiles = f.batchImages(images, self.img_size)
+        return self._tiles
+
+def createPlaneTracker(opt):
+    # plane state to carry across the frames of a sequence (None if disabled).
+    if not opt['plane_tracking']:
+        return None
+    return f.PlaneTracker(opt['tracking_refine_fraction'], opt['tracking_smoothing'],
+                          sample_points=opt['tracking_points'])
+
+class StereoPipeline(object):
+    """
+    Everything one stereo camera rig needs from frame to frame: its own
+    copy of the options, the frame count, the previous disparity, the
+    plane tracker and a workspace (with its own stereo matchers). Separate
+    pipelines share no mutable state, so one pipeline per rig can run on
+    its own thread.
+    """
+
+    def __init__(self, options=None):
+        self.options = dict(default_opts if options is None else options)
+        self.workspace = f.Workspace()
+        # frames of one rig have to be processed in order.
+        self.lock = threading.Lock()
+        # load (or compute) the rectification maps now, not on the first frame.
+        cal.getRectifier(self.options['calibration'], self.options['rectification_cache'])
+        self.reset()
+
+    def reset(self):
+        # forget the previous frames (e.g. after a jump in the sequence).
+        self.frame = 0
+        self.previous_disparity = None
+        self.tracker = createPlaneTracker(self.options)
+
+    def process(self, imgL, imgR, filename=None, stats=None, options=None):
+        """
+        Processes the next stereo pair, optionally with different options for
+        this frame only. Returns (result, normal) where the result is the
+        tiled image, or the StereoResult when headless.
+        """
+        opt = self.options if options is None else options
+        with self.lock:
+            self.frame += 1
+            result, self.previous_disparity, normal = performStereoVision(
+                imgL, imgR, self.previous_disparity, opt, stats, filename,
+                self.tracker, self.workspace, self.frame)
+        return result, normal
+
+def performStereoVision(imgL,imgR, prev_disp=None, opt=default_opts, stats=None, filename=None, tracker=None, workspace=None, frame=1):
+    # initiate stats list (or fill the one we were given).
+    if stats is None:
+        stats = {}
+    stats["Frame"] = frame
+    if opt['profiler'] is not None:
+        opt['profiler'].begin(frame)
     # add start timer.
     start_time = time.time()
+    clock = prof.StageClock(stats)
 
     # ------------------------------
     # 1. IMAGE PROCESSING
     # ------------------------------
 
+    # rectify raw frames with the maps of the rig's calibration (if it has one).
+    camera = f.default_camera
+    rectifier = cal.getRectifier(opt['calibration'], opt['rectification_cache'])
+    if rectifier is not None:
+        imgL, imgR = rectifier.rectify(imgL, imgR, workspace)
+        camera = rectifier.camera
+        clock.lap("Rectification")
+
     # perform preprocessing on images.
-    imgL, imgR = f.preProcessImages(imgL,imgR)
-    # make image greyscale
-    grayL, grayR = f.greyscale(imgL,imgR)
+    imgL, imgR = f.preProcessImages(imgL,imgR, workspace)
+    clock.lap("Preprocessing")
 
     # ------------------------------
     # 2. DISPARITY PROCESSING
     # ------------------------------
 
+    # the stereo processor to use (each thread has its own).
+    matcherSettings = f.matcherSettings(opt)
+    # only compute the disparity where the masks will keep it (if requested).
+    disparityROI = None
+    if opt['disparity_roi']:
+        disparityROI = f.masks.boundingBox(('car_view', 'disparity_cap'), imgL.shape)
+
+    # look for the disparity of this frame in the cache.
+    cachePath = None
+    cachedDisparity = None
+    if opt['disparity_cache'] and filename is not None:
+        cacheKey = f.disparityCacheKey(opt['max_disparity'], opt['crop_disparity'], disparityROI, opt['disparity_scale'], matcherSettings,
+                                       rectifier.key if rectifier is not None else None)
+        cachePath = f.disparityCachePath(opt['disparity_cache'], cacheKey, filename)
+        cachedDisparity = f.loadCachedDisparity(cachePath)
+        stats["Disparity Cache Hit"] = int(cachedDisparity is not None)
+
     # compute disparity image
     disparity = None
     try:
-        # generate disparity
-        disparity = f.disparity(grayL,grayR, opt['max_disparity'], opt['crop_disparity'])
+        if cachedDisparity is not None:
+            disparity = cachedDisparity
+        else:
+            # make image greyscale
+            grayL, grayR = f.greyscale(imgL,imgR, workspace)
+            clock.lap("Preprocessing")
+            # generate disparity
+            disparity = f.disparity(grayL,grayR, opt['max_disparity'], opt['crop_disparity'], disparityROI, opt['disparity_scale'], matcherSettings, workspace)
+            if cachePath is not None:
+                # a failed write only loses the cache entry, not the frame.
+                try:
+                    f.saveCachedDisparity(cachePath, disparity)
+                except Exception as e:
+                    print("There was an error caching the disparity:", e)
+        clock.lap("SGBM")
         # clean holes in the disparity
-        disparity = f.disparityCleaning(disparity, opt['threshold_option'], prev_disp)
+        plane = tracker.plane() if tracker is not None else None
+        disparity = f.disparityCleaning(disparity, opt['threshold_option'], prev_disp, plane,
+                                        f.disparityOrigin(opt['crop_disparity']), opt['ego_motion_max'], stats, workspace,
+                                        camera, opt['max_disparity'])
         # save the disparity and return that for the next iteration in the loop.
         prev_disp = disparity
     except Exception as e:
         # if theres an error in cleaning the disparity, return a black image.
         print("Cannot compute the disparity.")
-        disparity = f.getBlackImage()
-
-    # add the resulting image to the list of images.
-    images.append(("Disparity",disparity))
+        disparity = f.getBlackImage(imgL.shape)
+    clock.lap("Filling")
 
     # ------------------------------
     # 3. DISPARITY POST-PROCESSING
     # ------------------------------
 
+    # the masks are cropped the same way as the disparity.
+    origin = f.disparityOrigin(opt['crop_disparity'])
+    maskSize = imgL.shape if opt['crop_disparity'] else None
     # mask the disparity s.t we have a reccomended filter range.
-    maskedDisparity = f.maskDisparity(disparity)
+    maskedDisparity = f.maskDisparity(disparity, workspace, origin, maskSize)
     # cap the disparity since we know we don't really need most of the information there.
-    cappedDisparity = f.capDisparity(disparity)
+    # this used to be a no-op, so it is opt in (the ROI always needs it).
+    cappedDisparity = disparity
+    if opt['cap_disparity'] or opt['disparity_roi']:
+        cappedDisparity = f.capDisparity(disparity, workspace, origin, maskSize)
 
     # ------------------------------
     # 4. DISPARITY TO POINT CLOUDS
@@ -81,36 +286,60 @@ def performStereoVision(imgL,imgR, prev_disp=None, opt=default_opts):
 
     # project to a 3D colour point cloud
     # we have points and maskpoints because we generate a plane from the mask points and compare them to the points in the original disparity.
-    points = f.projectDisparityTo3d(cappedDisparity, opt['max_disparity'], imgL)
-    maskpoints = f.projectDisparityTo3d(maskedDisparity, opt['max_disparity'])
+    points = f.projectDisparityTo3d(cappedDisparity, opt['max_disparity'], imgL, opt['projection_stride'], origin, camera)
+    maskpoints = f.projectDisparityTo3d(maskedDisparity, opt['max_disparity'], step=opt['projection_stride'], origin=origin, camera=camera)
+    clock.lap("Projection")
 
     # ------------------------------
     # 5. PLANE FINDING WITH RANSAC
     # ------------------------------
-    planePoints = []
+    planePoints = np.empty((0,1,2), np.int32)
     normal = None
+    abc = None
+    cloud = points
+    inliers = None
+    # with a seed, every frame draws from its own generator s.t the plane only
+    # depends on the frame (and not on which process or thread ran the frames before it).
+    random = np.random
+    if opt['random_seed'] is not None:
+        random = np.random.RandomState((opt['random_seed'] * 1000003 + frame) % 2**32)
     try:
         # compute ransac which will give us the coefficents for our plane.
-        normal, abc = f.RANSAC(maskpoints, opt['ransac_trials'])
-
-        # we calculate the error distances between the points on the disparity and the plane.
-        pointDifferences = f.calculatePointErrors(abc, points)
+        if tracker is not None:
+            # start from (and smooth with) the plane of the previous frames.
+            normal, abc = tracker.fit(maskpoints, opt['ransac_trials'], opt['point_threshold'], opt['ransac_confidence'], stats, random)
+        else:
+            normal, abc = f.RANSAC(maskpoints, opt['ransac_trials'], opt['point_threshold'], opt['ransac_confidence'], stats, random=random)
+
+        # we calculate the error distances between the pixels of the disparity and the plane,
+        # and look up the error of every point from the pixel it was projected from.
+        stride = opt['projection_stride']
+        planeDistances = f.planeDistanceImage(cappedDisparity, abc, origin, camera, opt['max_disparity'], stride)
+        pointDifferences = planeDistances[points['uv'][:, 1] // stride, points['uv'][:, 0] // stride]
+        inliers = np.ravel(pointDifferences) < opt['point_threshold']
 
         # compute good points from the plane - using a threshold for a point limit.
         points = f.computePlanarThreshold(points,pointDifferences,opt['point_threshold'])
+        clock.lap("RANSAC")
         stats["Planar Points Before"] = len(points)
         # generate colour histogram from the road points
-        histogram = f.calculateColourHistogram(points)
+        binnedHues = f.binPointHues(points, opt['hue_bins'])
+        histogram = f.calculateColourHistogram(binnedHues, opt['hue_bins'])
 
         # filter the colours in the points using the histogram
-        points = f.filterPointsByHistogram(points, histogram, opt['road_color_thresh'])
+        points = f.filterPointsByHistogram(points, histogram, binnedHues, opt['road_color_thresh'])
+        clock.lap("Histogram")
         stats["Planar Points After"] = len(points)
 
         stats["Planar Pre-Filtering Accuracy"] =  stats["Planar Points After"]/stats["Planar Points Before"]
-        # convert 3D points back into 2d.
-        planePoints = f.project3DPointsTo2DImagePoints(points)
-        planePoints = np.array(planePoints, np.int32)
-        planePoints = planePoints.reshape((-1,1,2))
+        if opt['road_segmentation'] == 'pixel':
+            # use the pixels the points were projected from.
+            planePoints = points['uv']
+        else:
+            # convert 3D points back into 2d.
+            planePoints = f.project3DPointsTo2DImagePoints(points, camera) - origin
+            planePoints = planePoints.astype(np.int32)
+        planePoints = np.ascontiguousarray(planePoints).reshape((-1,1,2))
 
         # add to stats that we computed a plane properly.
         stats["Computed Planar"] = 1
@@ -128,22 +357,12 @@ def performStereoVision(imgL,imgR, prev_disp=None, opt=default_opts):
     # 6. DRAW POINTS INTO OWN IMAGE
     # ------------------------------
 
-    imageRoadMap = imgL.copy()
-    for i in planePoints:
-        imageRoadMap[i[0][1]][i[0][0]] = [0,255,0]
-    
-    # add the resulting image to the list of images.
-    images.append(("Image Road Map",imageRoadMap))
-
     roadImage = []
     try:
-        roadImage = f.generatePointsAsImage(planePoints)
+        roadImage = f.generatePointsAsImage(planePoints, disparity.shape)
     except Exception as e:
         print("There was an error with generating a road image:", e)
-        roadImage = f.getBlackImage()
-    
-    # add the resulting image to the list of images.
-    images.append(("Road Image",roadImage))
+        roadImage = f.getBlackImage(disparity.shape)
 
     # ------------------------------
     # 7. CLEAN ROAD POINTS
@@ -151,97 +370,94 @@ def performStereoVision(imgL,imgR, prev_disp=None, opt=default_opts):
 
     # sanitise the road image.
     cleanedRoadImage = []
-    resultingPoints = []
+    roadHull = None
     try:
-        cleanedRoadImage, resultingPoints = f.sanitiseRoadImage(roadImage, opt['img_size'])
+        # this also gives us the convex hull of the road, used from here on.
+        cleanedRoadImage, roadHull = f.sanitiseRoadImage(roadImage, workspace, origin, maskSize)
     except Exception as e:
         print("There was an error with cleaning the road image:", e)
         # since an error was found, use the original, uncleaned planepoints.
-        cleanedRoadImage = f.getBlackImage()
-        resultingPoints = planePoints
-    
-    # add the resulting image to the list of images.
-    images.append(("Filtered Road Image",cleanedRoadImage))
+        cleanedRoadImage = f.getBlackImage(disparity.shape)
+        if len(planePoints) > 0:
+            roadHull = cv2.convexHull(planePoints)
+    clock.lap("Sanitise")
 
     # ------------------------------
     # 8. DETECT OBSTACLES
     # ------------------------------
 
+    obstacleImage = None
+    obstacles = []
     try:
-        # convex hull on the road image
-        roadHull = cv2.convexHull(resultingPoints)
         # on our image, we will fill in our convex hull to make a mask.
-        cleanedRoadImage2 = cleanedRoadImage.copy()
-        cleanedRoadImage3 = cleanedRoadImage.copy()
-        hullMask = cv2.drawContours(cleanedRoadImage2,[roadHull],0,255,-100)
+        hullMask = f.scratch(workspace, 'hull mask', cleanedRoadImage.shape)
+        if hullMask is None:
+            hullMask = cleanedRoadImage.copy()
+        else:
+            np.copyto(hullMask, cleanedRoadImage)
+        hullMask = cv2.drawContours(hullMask,[roadHull],0,255,-100)
         # make an inverse of our road image to show the non road obstacles as white.
-        obstacleImage = cv2.bitwise_not(cleanedRoadImage3)
+        obstacleImage = cv2.bitwise_not(cleanedRoadImage)
         # mask this image with the hull mask.
         obstacleImage = cv2.bitwise_and(obstacleImage, obstacleImage, mask=hullMask)
-        # convert obstacle image to bgr
-        obstacleImage = cv2.cvtColor(obstacleImage, cv2.COLOR_GRAY2BGR)
-        # turn image yellow.
-        obstacleImage[np.where((obstacleImage == [255,255,255]).all(axis = 2))] = [0,255,255]
-        # we then overlay the obstacle image to the display image so that we can see where obstacles are.
-        alpha = 0.4
-        imgL = cv2.addWeighted(obstacleImage, alpha, imgL, 1 - alpha, 0, imgL)
+        # split it into obstacles, measured from the disparity and the plane.
+        obstacles = f.findObstacles(obstacleImage, disparity, abc, origin, opt['obstacle_min_area'],
+                                    camera, opt['max_disparity'])
+        stats["Obstacles"] = len(obstacles)
     except Exception as e:
         print("There was an error in detecting obstacles:", e)
 
     # ------------------------------
-    # 9. DRAW ROAD AND NORMAL LINES
+    # 9. ROAD CENTRE
     # ------------------------------
-    resulting_image = imgL
-    
+
+    center = None
     try:
-        # generate convex hull and draw it on the image.
-        imgL, hull = f.drawRoadLine(imgL, resultingPoints)
         # get center point from the hull points.
-        center =  f.getCenterPoint(hull)
+        center =  f.getCenterPoint(roadHull)
         stats["Center Point X"] = center[0]
         stats["Center Point Y"] = center[1]
-        # draw normal line.
-        resulting_image = f.drawNormalLine(imgL, center, normal, disparity)
     except Exception as e:
         print("There was an error with generating a hull:", e)
-        
-    # add the resulting image to the list of images.
-    images.append(("Result",resulting_image))
+    clock.lap("Obstacles")
+
+    result = StereoResult(imgL, disparity, normal, roadImage, cleanedRoadImage,
+                          roadHull, center, obstacleImage, obstacles, stats, opt['img_size'],
+                          cloud, inliers, camera, opt['max_disparity'], origin)
 
     # ------------------------------
     # 10*. GENERATE IMAGE TILES
     # * This is optional but it shows the processed images.
     # ------------------------------
 
-    img_tile = f.batchImages(images, opt['img_size'])
+    img_tile = None
+    if not opt['headless']:
+        result.overlay()
+        clock.lap("Drawing")
+        img_tile = result.tiles()
+        clock.lap("Tiling")
 
     # calculate time taken and add it to stats.
     stats["Time Taken"] = round(time.time() - start_time, 3)
 
-    if opt['loop'] == True:
+    if opt['loop'] == True and not opt['headless']:
         # display image results.
         cv2.imshow('Result',img_tile)
-        f.handleKey(cv2, opt['pause_playback'], disparity, imgL, imgR, opt['crop_disparity'])
+        f.handleKey(cv2, opt['pause_playback'], disparity, result.overlay(), imgR, opt['crop_disparity'], opt['output_sink'])
+
+    if opt['output_sink'] is not None:
+        # per frame artefacts (if any were asked for).
+        opt['output_sink'].result(filename, result)
 
+    if opt['stats_hook'] is not None:
+        opt['stats_hook'](stats)
     if opt['record_stats']:
-        if opt['frame'] == 1:
-            # write headers for first frame.
-            headers = []
-            for key in stats.keys():
-                headers.append(str(key))
-            with open("statistics.csv", 'w') as fp:
-                writer = csv.writer(fp, delimiter=',')
-                writer.writerow(headers)
-   
-        # set up input to write to csv file.
-        statistics = []
-        for key in stats.keys():
-            statistics.append(str(stats[key]))
-
-        # write results to file.
-        with open("statistics.csv", 'a') as fp:
-            writer = csv.writer(fp, delimiter=',')
-            writer.writerow(statistics)
-
-    # return the results.
+        # written by one buffered writer for the whole run.
+        prof.getStatsWriter(opt['stats_filename'], opt['stats_format']).write(stats)
+    if opt['profiler'] is not None:
+        opt['profiler'].end(frame)
+
+    # return the results (only the structured ones when headless).
+    if opt['headless']:
+        return result, prev_disp, normal
     return img_tile, prev_disp, normal
\ No newline at end of file
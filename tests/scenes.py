@@ -0,0 +1,18 @@
+import cv2
+import numpy as np
+import functions as f
+
+def stereoPair(seed=0, height=1.5, size=(544, 1024)):
+    # a textured flat road `height` metres below the camera, with a constant
+    # small disparity above the horizon.
+    rows, cols = size
+    rng = np.random.default_rng(seed)
+    texture = cv2.GaussianBlur(rng.integers(0, 256, (rows, cols + 200, 3)).astype(np.uint8), (3, 3), 0)
+    imgL = texture[:, 100:100 + cols].copy()
+    imgR = np.empty_like(imgL)
+    camera = f.default_camera
+    for y in range(rows):
+        d = camera.baseline * (y - camera.centre_h) / height if y > camera.centre_h + 5 else 2.0
+        shift = int(round(d))
+        imgR[y] = texture[y, 100 + shift:100 + shift + cols]
+    return imgL, imgR
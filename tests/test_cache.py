@@ -0,0 +1,49 @@
+import os
+import threading
+import numpy as np
+import functions as f
+import stereovision as sv
+from scenes import stereoPair
+
+def test_unwritable_cache_keeps_the_disparity(tmp_path):
+    # a file where the cache directory should be, s.t every write fails.
+    cache = tmp_path / "cache"
+    cache.write_text("")
+    options = dict(sv.default_opts, loop=False, headless=True, disparity_cache=str(cache), random_seed=0)
+    stats = {}
+    result, normal = sv.StereoPipeline(options).process(*stereoPair(), filename="0_L.png", stats=stats)
+    assert stats["Disparity Cache Hit"] == 0
+    assert np.count_nonzero(result.disparity) > 0
+    assert normal is not None
+
+def test_concurrent_saves_of_one_path(tmp_path):
+    path = str(tmp_path / "key" / "0_L.npy")
+    arrays = [np.full((200, 300), i, np.uint8) for i in range(8)]
+    errors = []
+    def save(array):
+        try:
+            for _ in range(20):
+                f.atomicSave(path, array)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=save, args=(array,)) for array in arrays]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    # one whole array, and no temporary files left behind.
+    saved = np.load(path)
+    assert saved.shape == (200, 300) and len(np.unique(saved)) == 1
+    assert os.listdir(os.path.dirname(path)) == ["0_L.npy"]
+
+def test_rectification_maps_are_cached(tmp_path):
+    import calibration
+    K = np.array([[400., 0, 160], [0, 400, 120], [0, 0, 1]])
+    rig = calibration.Calibration((240, 320), K, np.zeros(5), K, np.zeros(5), np.eye(3), [-0.2, 0, 0])
+    first = calibration.Rectifier(rig, str(tmp_path))
+    assert sorted(os.listdir(tmp_path / rig.key())) == ["fractions.npy", "positions.npy"]
+    cached = calibration.Rectifier(rig, str(tmp_path))
+    assert isinstance(cached.positions, np.memmap)
+    assert np.array_equal(cached.positions, first.positions)
+    assert np.array_equal(cached.fractions, first.fractions)
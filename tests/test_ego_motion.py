@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import functions as f
+
+camera = f.default_camera
+size = (544, 1024)
+camera_height = 1.5
+road = np.array([[0.], [1. / camera_height], [0.]])
+# boxes standing on the road: (left, right, distance along the road, height) in metres.
+boxes = [(-4.0, -2.0, 14.0, 2.0), (1.5, 3.0, 18.0, 1.5), (-1.0, 0.5, 25.0, 1.2), (3.5, 6.0, 11.0, 2.5)]
+
+def renderDisparity(travelled, boxes=boxes, max_disparity=128):
+    # the 8-bit disparity seen after driving `travelled` metres down a flat
+    # road with a wall 40 m ahead of the camera.
+    ys, xs = np.mgrid[0:size[0], 0:size[1]].astype(np.float64)
+    dx = (xs - camera.centre_w) / camera.focal_length
+    dy = (ys - camera.centre_h) / camera.focal_length
+    with np.errstate(divide='ignore'):
+        depth = np.minimum(40.0, np.where(dy > 1e-6, camera_height / dy, np.inf))
+    for left, right, distance, height in boxes:
+        Z = distance - travelled
+        if Z <= 0.5:
+            continue
+        X, Y = dx * Z, dy * Z
+        front = (X >= left) & (X <= right) & (Y <= camera_height) & (Y >= camera_height - height)
+        depth = np.where(front & (Z < depth), Z, depth)
+    value = np.rint(camera.focal_length * camera.baseline / depth * 256. / max_disparity)
+    return np.clip(value, 0, 255).astype(np.uint8)
+
+@pytest.mark.parametrize("speed", [0.5, 1.0, 1.5])
+def test_constant_motion_is_recovered(speed):
+    for frame in range(5):
+        previous, current = renderDisparity(frame * speed), renderDisparity((frame + 1) * speed)
+        translation = f.estimateEgoMotion(current, previous, road)
+        assert translation is not None
+        assert np.linalg.norm(translation) == pytest.approx(speed, abs=0.25)
+        # straight down the road.
+        assert translation[2] == pytest.approx(np.linalg.norm(translation))
+
+def test_no_motion():
+    disparity = renderDisparity(2.0)
+    assert np.linalg.norm(f.estimateEgoMotion(disparity, disparity, road)) == 0
+
+def test_flat_residual_falls_back_to_previous():
+    # only the road and the far wall, neither of which tells how far we moved.
+    previous, current = renderDisparity(0.0, []), renderDisparity(1.0, [])
+    assert f.estimateEgoMotion(current, previous, road) is None
+    current[300:310, 500:510] = 0
+    stats = {}
+    filled = f.disparityCleaning(current.copy(), 'warp', previous, road, stats=stats)
+    assert stats["Ego Motion"] == "-"
+    assert np.array_equal(filled, f.fillDisparity(current.copy(), previous))
+
+def test_warp_without_a_plane_falls_back_to_previous():
+    previous, current = renderDisparity(3.0), renderDisparity(4.0)
+    current[300:310, 500:510] = 0
+    stats = {}
+    filled = f.disparityCleaning(current.copy(), 'warp', previous, None, stats=stats)
+    assert stats["Ego Motion"] == "-"
+    assert np.array_equal(filled, f.fillDisparity(current.copy(), previous))
+
+def test_warp_fill_uses_the_motion():
+    previous, current = renderDisparity(3.0), renderDisparity(4.0)
+    stats = {}
+    f.disparityCleaning(current.copy(), 'warp', previous, road, stats=stats)
+    assert stats["Ego Motion"] == pytest.approx(1.0, abs=0.25)
+    # the warped previous disparity predicts the current one where both are known.
+    warped = f.warpDisparity(previous, np.array([0., 0., 1.0]))
+    known = (warped > 0) & (current > 0)
+    assert np.mean(np.abs(warped[known].astype(int) - current[known])) < np.mean(np.abs(previous[known].astype(int) - current[known]))
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import functions as f
+import stereovision as sv
+import export
+
+camera = f.default_camera
+
+def knownResult(max_disparity=128):
+    # a result whose cloud has a single point 8 m ahead, 1 m left and 1.5 m down.
+    Z, X, Y = 8.0, -1.0, 1.5
+    x = int(round(X * camera.focal_length / Z + camera.centre_w))
+    y = int(round(Y * camera.focal_length / Z + camera.centre_h))
+    value = int(round(camera.focal_length * camera.baseline / Z * 256. / max_disparity))
+    disparity = np.zeros((544, 1024), np.uint8)
+    disparity[y, x] = value
+    image = np.zeros((544, 1024, 3), np.uint8)
+    image[y, x] = (10, 20, 30)
+    points = f.projectDisparityTo3d(disparity, max_disparity, image, step=1)
+    # where the point must be after the 8-bit disparity is converted back.
+    Zq = camera.focal_length * camera.baseline / (value * max_disparity / 256.)
+    expected = ((x - camera.centre_w) / camera.focal_length * Zq, (y - camera.centre_h) / camera.focal_length * Zq, Zq)
+    result = sv.StereoResult(image, disparity, None, None, np.zeros((544, 1024), np.uint8), None, None, None, [],
+                             {"Frame": 1}, (544, 1024), points, np.array([True]), max_disparity=max_disparity)
+    return result, expected, (X, Y, Z)
+
+def checkCloud(cloud, expected, approximate):
+    assert len(cloud) == 1
+    assert cloud['xyz'][0] == pytest.approx(expected, rel=1e-5)
+    # within the resolution of the 8-bit disparity of the true point.
+    assert cloud['xyz'][0] == pytest.approx(approximate, rel=0.05)
+    assert tuple(cloud['rgb'][0]) == (30, 20, 10)
+    assert cloud['inlier'][0] == 1
+
+def test_ply_round_trip_keeps_metres(tmp_path):
+    result, expected, approximate = knownResult()
+    export.writePLY(str(tmp_path / "cloud.ply"), result.cloud())
+    checkCloud(export.readPLY(str(tmp_path / "cloud.ply")), expected, approximate)
+
+def test_store_round_trip_keeps_metres(tmp_path):
+    result, expected, approximate = knownResult(64)
+    store = export.FrameStore(str(tmp_path / "drive"))
+    store.append("frame", result.cloud(), result.road_mask, 1)
+    store.close()
+    name, cloud, mask = export.FrameStore(str(tmp_path / "drive")).frame(0)
+    assert name == "frame"
+    assert mask.shape == (544, 1024)
+    checkCloud(cloud, expected, approximate)
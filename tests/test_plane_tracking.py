@@ -0,0 +1,33 @@
+import numpy as np
+import functions as f
+
+def roadCloud(count=20000, height=1.5, seed=0):
+    # points on a flat road 1.5 m below the camera, a fifth of them off it.
+    random = np.random.RandomState(seed)
+    xyz = np.column_stack([random.uniform(-5, 5, count), np.full(count, height), random.uniform(3, 40, count)])
+    xyz[:, 1] += random.normal(0, 0.02, count)
+    off = random.rand(count) < 0.2
+    xyz[off, 1] -= random.uniform(0.3, 2.0, np.count_nonzero(off))
+    return xyz.astype(np.float32)
+
+def test_tracked_plane_is_refitted_on_a_subset(monkeypatch):
+    cloud = roadCloud()
+    tracker = f.PlaneTracker(sample_points=2000)
+    random = np.random.RandomState(1)
+    stats = {}
+    tracker.fit(cloud, 100, 0.1, 0.99, stats, random)
+    assert stats["Plane Tracked"] == 0
+
+    sizes = []
+    ransac = f.RANSAC
+    def countingRANSAC(points, *args, **kwargs):
+        sizes.append(len(points))
+        return ransac(points, *args, **kwargs)
+    monkeypatch.setattr(f, "RANSAC", countingRANSAC)
+    _, abc = tracker.fit(cloud, 100, 0.1, 0.99, stats, random)
+    assert stats["Plane Tracked"] == 1
+    assert sizes == [2000]
+    # still the road: unit normal along Y, 1.5 m from the camera.
+    normal = np.ravel(abc) / np.linalg.norm(abc)
+    assert abs(normal[1]) > 0.999
+    assert abs(1. / np.linalg.norm(abc) - 1.5) < 0.02
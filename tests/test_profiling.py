@@ -0,0 +1,39 @@
+import csv
+import threading
+import profiling as prof
+
+def readRows(path):
+    with open(path, newline='') as fp:
+        return list(csv.DictReader(fp))
+
+def test_csv_columns_added_by_later_frames_are_kept(tmp_path):
+    path = str(tmp_path / "stats.csv")
+    writer = prof.StatsWriter(path, flush_every=1)
+    writer.write({"Frame": 1, "Time Taken": 0.1})
+    writer.write({"Frame": 2, "Time Taken": 0.2, "Ego Motion": 0.5})
+    writer.write({"Frame": 3, "Time Taken": 0.3})
+    writer.close()
+    rows = readRows(path)
+    assert [row["Frame"] for row in rows] == ["1", "2", "3"]
+    assert [row["Ego Motion"] for row in rows] == ["-", "0.5", "-"]
+    # every timed stage has a column from the start.
+    for stage in prof.stages:
+        assert rows[0]["Time " + stage] == "-"
+
+def test_one_writer_per_file_across_threads(tmp_path):
+    path = str(tmp_path / "shared.csv")
+    writers = []
+    barrier = threading.Barrier(8)
+
+    def get():
+        barrier.wait()
+        writers.append(prof.getStatsWriter(path))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(writer is writers[0] for writer in writers)
+    writers[0].close()
+    del prof.default_writers[(path, "csv")]
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import functions as f
+
+camera = f.default_camera
+size = (544, 1024)
+
+def disparityOf(Z, max_disparity):
+    # the 8-bit disparity() value of a point at depth Z (metres).
+    return np.rint(camera.focal_length * camera.baseline / Z * 256. / max_disparity)
+
+def roadDisparity(height, max_disparity):
+    # the 8-bit disparity of a flat road `height` metres below the camera.
+    rows = np.arange(size[0], dtype=np.float64) - camera.centre_h
+    values = np.zeros(size[0])
+    below = rows > 0
+    values[below] = disparityOf(height * camera.focal_length / rows[below], max_disparity)
+    disparity = np.repeat(np.clip(values, 0, 255)[:, None], size[1], axis=1)
+    return disparity.astype(np.uint8)
+
+@pytest.mark.parametrize("max_disparity", [64, 128])
+def test_depth_is_in_metres(max_disparity):
+    value = disparityOf(10.0, max_disparity)
+    disparity = np.zeros(size, np.uint8)
+    disparity[300, 600] = value
+    points = f.projectDisparityTo3d(disparity, max_disparity, step=1)
+    expected = camera.focal_length * camera.baseline / (value * max_disparity / 256.)
+    assert len(points) == 1
+    assert points['xyz'][0, 2] == pytest.approx(expected, rel=1e-5)
+    assert points['xyz'][0, 2] == pytest.approx(10.0, rel=0.05)
+    assert points['xyz'][0, 0] == pytest.approx((600 - camera.centre_w) / camera.focal_length * expected, rel=1e-5)
+
+@pytest.mark.parametrize("max_disparity", [64, 128])
+def test_road_plane_distance_is_camera_height(max_disparity):
+    disparity = roadDisparity(1.5, max_disparity)
+    points = f.projectDisparityTo3d(disparity, max_disparity)
+    # only the near road, where the 8-bit disparity is fine enough.
+    xyz = points['xyz'][points['xyz'][:, 2] < 15].astype(np.float64)
+    abc = f.refitPlane(xyz)
+    assert 1. / np.linalg.norm(abc) == pytest.approx(1.5, abs=0.05)
+    distances = f.planeDistanceImage(disparity, abc, max_disparity=max_disparity)
+    assert np.median(distances[disparity > 0]) < 0.05
+
+def test_obstacle_distance_in_metres():
+    max_disparity = 128
+    disparity = roadDisparity(1.5, max_disparity)
+    mask = np.zeros(size, np.uint8)
+    # a box 10 m ahead, standing 1 m tall on the road.
+    top = int(camera.centre_h + 0.5 * camera.focal_length / 10.0)
+    bottom = int(camera.centre_h + 1.5 * camera.focal_length / 10.0)
+    disparity[top:bottom, 480:520] = disparityOf(10.0, max_disparity)
+    mask[top:bottom, 480:520] = 255
+    abc = np.array([[0.], [1. / 1.5], [0.]])
+    obstacles = f.findObstacles(mask, disparity, abc, max_disparity=max_disparity)
+    assert len(obstacles) == 1
+    assert obstacles[0].distance == pytest.approx(10.0, rel=0.05)
+    assert obstacles[0].height == pytest.approx(1.0, abs=0.15)
+
+@pytest.mark.parametrize("step", [1, 2, 3])
+def test_plane_distance_image_matches_point_errors(step):
+    rng = np.random.default_rng(step)
+    disparity = rng.integers(0, 256, size, dtype=np.uint8)
+    abc = np.array([[0.01], [0.6], [-0.02]])
+    points = f.projectDisparityTo3d(disparity, 128, step=step)
+    distances = f.planeDistanceImage(disparity, abc, step=step)
+    lookedUp = distances[points['uv'][:, 1] // step, points['uv'][:, 0] // step]
+    assert lookedUp == pytest.approx(np.ravel(f.calculatePointErrors(abc, points)), rel=1e-4, abs=1e-5)
+    assert np.all(np.isinf(distances[disparity[::step, ::step] == 0]))
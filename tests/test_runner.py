@@ -0,0 +1,55 @@
+import os
+import time
+import cv2
+import numpy as np
+import functions as f
+import stereovision as sv
+import runner
+from scenes import stereoPair
+
+def writeSequence(root, count):
+    left, right = os.path.join(root, "left"), os.path.join(root, "right")
+    os.makedirs(left)
+    os.makedirs(right)
+    for i in range(count):
+        imgL, imgR = stereoPair(i, height=1.4 + 0.05 * i)
+        cv2.imwrite(os.path.join(left, "%d_L.png" % i), imgL)
+        cv2.imwrite(os.path.join(right, "%d_R.png" % i), imgR)
+    return left, right
+
+def test_batch_matches_serial_run(tmp_path):
+    left, right = writeSequence(str(tmp_path), 4)
+    # frames that don't depend on the ones before them.
+    options = dict(sv.default_opts, loop=False, random_seed=0, threshold_option='mean', plane_tracking=False)
+    filelist = sorted(os.listdir(left))
+    results = runner.runBatch(filelist, left, right, options, processes=2, overlap=1)
+    pipeline = sv.StereoPipeline(options)
+    assert len(results) == 4
+    for filename_l, normal, stats, _ in results:
+        imgL, imgR = f.loadImages(f.getImagePaths(filename_l, left, right))
+        serialStats = {}
+        _, serialNormal = pipeline.process(imgL, imgR, filename_l, serialStats)
+        assert stats["Frame"] == serialStats["Frame"]
+        assert np.array_equal(normal, serialNormal)
+        assert stats["RANSAC Trials"] == serialStats["RANSAC Trials"]
+
+def test_seeded_runs_repeat():
+    options = dict(sv.default_opts, loop=False, headless=True, random_seed=3)
+    normals = []
+    for _ in range(2):
+        pipeline = sv.StereoPipeline(options)
+        normals.append([pipeline.process(*stereoPair(i))[1] for i in range(2)])
+    assert all(np.array_equal(a, b) for a, b in zip(*normals))
+
+def test_pipelined_run_over_a_list_of_frames():
+    frames = [("%d_L.png" % i, stereoPair(i), time.perf_counter()) for i in range(2)]
+    options = dict(sv.default_opts, loop=False, headless=True)
+    assert runner.runPipelined(frames, options) > 0
+
+def test_streams_over_lists_of_frames():
+    streams = [[("%d_L.png" % i, stereoPair(i), time.perf_counter()) for i in range(2)] for _ in range(2)]
+    options = dict(sv.default_opts, loop=False, headless=True)
+    seen = []
+    frames = runner.runStreams(streams, options, callback=lambda index, filename_l, image, normal, stats: seen.append(index))
+    assert frames == [2, 2]
+    assert sorted(seen) == [0, 0, 1, 1]
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+import cv2
+import numpy as np
+import sources
+import quality
+
+def writePairs(root, count, age=0.0):
+    # count stereo pairs, written `age` seconds ago.
+    left, right = os.path.join(root, "left"), os.path.join(root, "right")
+    os.makedirs(left, exist_ok=True)
+    os.makedirs(right, exist_ok=True)
+    image = np.zeros((8, 8, 3), np.uint8)
+    written = time.time() - age
+    for i in range(count):
+        for directory, side in ((left, "L"), (right, "R")):
+            path = os.path.join(directory, "%d_%s.png" % (i, side))
+            cv2.imwrite(path, image)
+            os.utime(path, (written, written))
+    return left, right
+
+def test_watched_frames_are_stamped_when_written(tmp_path):
+    left, right = writePairs(str(tmp_path), 3, age=5.0)
+    source = sources.DirectorySource(left, right, watch=True, poll_interval=0.01, idle_timeout=0.05)
+    controller = quality.QualityController(0.5, drop_after=2.0)
+    frames = list(source)
+    assert len(frames) == 3
+    for _, images, captured in frames:
+        assert images is not None
+        assert time.perf_counter() - captured >= 5.0
+        # five seconds is more than two deadlines behind.
+        assert controller.drop(captured)
+
+def test_fresh_watched_frames_are_not_dropped(tmp_path):
+    left, right = writePairs(str(tmp_path), 2)
+    source = sources.DirectorySource(left, right, watch=True, poll_interval=0.01, idle_timeout=0.05)
+    controller = quality.QualityController(0.5, drop_after=2.0)
+    assert not any(controller.drop(captured) for _, _, captured in source)
+
+def test_unpaired_left_does_not_hold_back_later_frames(tmp_path):
+    left, right = writePairs(str(tmp_path), 3)
+    os.remove(os.path.join(right, "0_R.png"))
+    source = sources.DirectorySource(left, right, watch=True, poll_interval=0.01, idle_timeout=0.05)
+    frames = list(source)
+    assert [name for name, _, _ in frames] == ["0_L.png", "1_L.png", "2_L.png"]
+    # the unpaired left is passed on as a skipped frame.
+    assert frames[0][1] is None
+    assert all(images is not None for _, images, _ in frames[1:])
+
+def test_unpaired_newest_left_is_waited_for(tmp_path):
+    left, right = writePairs(str(tmp_path), 2)
+    os.remove(os.path.join(right, "1_R.png"))
+    source = sources.DirectorySource(left, right, watch=True, poll_interval=0.01, idle_timeout=0.05)
+    assert [name for name, _, _ in source] == ["0_L.png"]
+
+def test_partially_written_image_is_read_again(tmp_path):
+    left, right = writePairs(str(tmp_path), 1)
+    path = os.path.join(left, "0_L.png")
+    with open(path, "rb") as image_file:
+        data = image_file.read()
+    with open(path, "wb") as image_file:
+        image_file.write(data[:len(data) // 2])
+    def finishWriting():
+        with open(path, "wb") as image_file:
+            image_file.write(data)
+    timer = threading.Timer(0.1, finishWriting)
+    timer.start()
+    source = sources.DirectorySource(left, right, watch=True, poll_interval=0.01, idle_timeout=0.5)
+    frames = list(source)
+    timer.join()
+    assert len(frames) == 1
+    assert frames[0][1] is not None and frames[0][1][0] is not None
+
+def test_recorded_frames_are_stamped_when_read(tmp_path):
+    left, right = writePairs(str(tmp_path), 3, age=5.0)
+    controller = quality.QualityController(0.5, drop_after=2.0)
+    frames = list(sources.DirectorySource(left, right))
+    assert len(frames) == 3
+    assert not any(controller.drop(captured) for _, _, captured in frames)
+
+def test_camera_holds_at_most_buffer_frames():
+    recorded = [("frame_%d" % i, (None, None), 0.0) for i in range(10)]
+    camera = sources.CameraSource(recorded, fps=200, buffer=1)
+    frames = iter(camera)
+    assert next(frames)[0] == "frame_0"
+    # while we are busy, the camera keeps emitting and only the newest frame waits.
+    time.sleep(0.3)
+    assert [name for name, _, _ in frames] == ["frame_9"]
+    assert camera.dropped == 8
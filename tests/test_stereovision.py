@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import functions as f
+import stereovision as sv
+from scenes import stereoPair
+
+@pytest.mark.parametrize("crop_disparity", [False, True])
+def test_result_images_with_crop(crop_disparity):
+    np.random.seed(0)
+    options = dict(sv.default_opts, loop=False, headless=True, crop_disparity=crop_disparity)
+    result, normal = sv.StereoPipeline(options).process(*stereoPair())
+    x, y = f.disparityOrigin(crop_disparity)
+    assert result.origin == (x, y)
+    height, width = result.disparity.shape
+    roadMap = result.roadMap()
+    assert roadMap.shape == result.image.shape
+    # the road is painted where the road mask is, offset by the crop.
+    green = np.all(roadMap == (0, 255, 0), axis=2)
+    assert np.array_equal(green[y:y + height, x:x + width], result.road_image > 0)
+    assert not green[y + height:].any() and not green[:, :x].any()
+    assert result.overlay().shape == result.image.shape
+    assert result.tiles().shape[1] == options['img_size'][1]
+    # the fitted road is 1.5 m below the camera.
+    assert 1. / np.linalg.norm(normal) == pytest.approx(1.5, abs=0.1)
+
+def test_capDisparity_zeroes_outside_the_cap_mask():
+    disparity = np.full((544, 1024), 100, np.uint8)
+    capped = f.capDisparity(disparity)
+    cap = f.masks.get('disparity_cap', disparity.shape)
+    assert np.all(capped[cap > 0] == 100)
+    assert np.all(capped[cap == 0] == 0)
+
+@pytest.mark.parametrize("overrides,capped", [({}, False), ({'cap_disparity': True}, True), ({'disparity_roi': True}, True)])
+def test_disparity_cap_is_opt_in(monkeypatch, overrides, capped):
+    calls = []
+    capDisparity = f.capDisparity
+    def countingCap(*args, **kwargs):
+        calls.append(1)
+        return capDisparity(*args, **kwargs)
+    monkeypatch.setattr(f, "capDisparity", countingCap)
+    options = dict(sv.default_opts, loop=False, headless=True, **overrides)
+    sv.StereoPipeline(options).process(*stereoPair())
+    assert bool(calls) == capped